@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class AccountExecutor():
+    # Executor facade over a pool shared by several accounts: at most max_workers of this account's tasks run at once,
+    # the others wait in its own queue, so a busy account can't take every shared worker from the others.
+    _pool: ThreadPoolExecutor
+    _max_workers: int
+    _pending: deque
+    _running: int
+    _shutdown: bool
+    _condition: threading.Condition
+
+    def __init__(self, pool: ThreadPoolExecutor, max_workers):
+        self._pool = pool
+        self._max_workers = max_workers
+        self._pending = deque()
+        self._running = 0
+        self._shutdown = False
+        self._condition = threading.Condition()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._pending.append((future, fn, args, kwargs))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        ready = []
+        with self._condition:
+            while self._running < self._max_workers and self._pending:
+                future, fn, args, kwargs = self._pending.popleft()
+                if future.set_running_or_notify_cancel():
+                    self._running += 1
+                    ready.append((future, fn, args, kwargs))
+        for task in ready:
+            self._pool.submit(self._run, *task)
+
+    def _run(self, future: Future, fn, args, kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as err:  # includes SystemExit raised by the clients' exit(1), like ThreadPoolExecutor.
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+            self._dispatch()
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        # Same contract as Executor.shutdown, the shared pool itself keeps running for the other accounts.
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                while self._pending:
+                    self._pending.popleft()[0].cancel()
+            if wait:
+                self._condition.wait_for(lambda: self._running == 0 and not self._pending)
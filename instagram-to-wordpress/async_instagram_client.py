@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import asyncio
+import io
+import json
+import os
+import aiohttp
+from datetime import datetime, timedelta
+from http_session import STREAM_CHUNK_SIZE
+from instagram_client import InstagramClient, InstagramMedia, InstagramUser
+from request_metrics import RequestMetrics
+from request_scheduler import RequestScheduler, get_shared_scheduler
+
+
+class AsyncInstagramClient():
+    last_post_fetch_date: float
+    _user_id: str
+    _access_token: str
+    _expiration_date: float
+    _config_file: str
+    _session: aiohttp.ClientSession
+    _owns_session: bool
+    _concurrency: int
+    _semaphore: asyncio.Semaphore
+    _scheduler: RequestScheduler
+    metrics: RequestMetrics
+    DEFAULT_CONCURRENCY = 16
+    _API_VERSION = InstagramClient._API_VERSION
+    _ALL_CHILDREN_MEDIA_FIELDS = InstagramClient._ALL_CHILDREN_MEDIA_FIELDS
+    _ALL_MEDIA_FIELDS = InstagramClient._ALL_MEDIA_FIELDS
+    _ALL_USER_FIELDS = InstagramClient._ALL_USER_FIELDS
+    _BASE_API_PATH = InstagramClient._BASE_API_PATH
+
+    def __init__(self, config_file, session: aiohttp.ClientSession = None, concurrency=DEFAULT_CONCURRENCY,
+                 scheduler: RequestScheduler = None, base_api_path=None, metrics: RequestMetrics = None):
+        required_keys = ['user_id', 'access_token', 'expiration_date', 'last_post_fetch_date']
+        with open(config_file) as f:
+            config = json.load(f)
+        missing_keys = [key for key in required_keys if key not in config]
+        if missing_keys:
+            # Only the key names, the configuration holds the access token.
+            print(f'Missing required keys {missing_keys} from configuration file: {config_file}')
+            exit(1)
+
+        self._user_id = config['user_id']
+        self._access_token = config['access_token']
+        self._expiration_date = config['expiration_date']
+        self.last_post_fetch_date = config['last_post_fetch_date'] if 'last_post_fetch_date' in config else 0
+        self._config_file = config_file
+        self._session = session
+        self._owns_session = session is None
+        # Bounds in-flight requests for this client, however many tasks share it.
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._scheduler = scheduler if scheduler else get_shared_scheduler()
+        self.metrics = metrics if metrics else RequestMetrics('instagram')
+        if base_api_path:
+            self._BASE_API_PATH = base_api_path
+        self._scheduler.limit_api_host(self._BASE_API_PATH)
+
+    async def __aenter__(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self._concurrency))
+        await self._refresh_token_if_needed()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._owns_session:
+            await self._session.close()
+
+    async def _get_json(self, url, request_name):
+        async with self._semaphore:
+            response = await self._scheduler.request_async(self._session, 'GET', url, metrics=self.metrics, endpoint=request_name)
+            async with response:
+                response_json = await response.json(content_type=None)
+
+            if response.status != 200:
+                print(f'Error while trying to make {request_name} request [{InstagramClient._redacted(response.url)}]: {response_json}')
+                exit(1)
+
+            return response_json
+
+    async def _refresh_token_if_needed(self):
+        now_timestamp = datetime.timestamp(datetime.now())
+        if self._expiration_date - now_timestamp <= 15 * 24 * 60 * 60:  # 15 days in seconds
+            print('Access token will be renewed.')
+            await self._refresh_token()
+
+    async def _refresh_token(self):
+        long_lived_json = await self._get_json(
+            f'{self._BASE_API_PATH}/refresh_access_token?grant_type=ig_refresh_token&access_token={self._access_token}', 'refresh token')
+
+        required_keys = ['access_token', 'expires_in']
+        if any(key not in long_lived_json for key in required_keys):
+            print(f'Missing one or more required keys ({required_keys}) from response of long lived request: {long_lived_json}')
+            exit(1)
+        self._access_token = long_lived_json['access_token']
+        time_change = timedelta(seconds=long_lived_json['expires_in'])
+        self._expiration_date = datetime.timestamp(datetime.now() + time_change)
+        self._refresh_config_file()
+
+    def _refresh_config_file(self):
+        with io.open(self._config_file, 'w', encoding='utf-8') as f:
+            json_data = json.dumps({'access_token': self._access_token,
+                                    'user_id': self._user_id,
+                                    'expiration_date': self._expiration_date,
+                                    'last_post_fetch_date': self.last_post_fetch_date}, ensure_ascii=False, indent=2)
+            f.write(json_data)
+
+    def set_fetch_date(self, fetch_date):
+        self.last_post_fetch_date = fetch_date
+        self._refresh_config_file()
+
+    async def get_user_details(self, fields=_ALL_USER_FIELDS):
+        response_json = await self._get_json(
+            f'{self._BASE_API_PATH}/{self._API_VERSION}/{self._user_id}?access_token={self._access_token}&fields={fields}', 'user details')
+        return InstagramUser(response_json)
+
+    async def _iter_pages(self, url, request_name):
+        while url:
+            response_json = await self._get_json(url, request_name)
+            for item in response_json.get('data', []):
+                yield item
+            url = response_json.get('paging', {}).get('next')
+
+    async def iter_user_medias(self, since: int = None, until: int = None, fields=_ALL_MEDIA_FIELDS, with_children_data=False, exclude_media_ids=[], expand_children=True):
+        print(f'Fetching media from profile since: {datetime.fromtimestamp(since if since else 0)}')
+        exclude_media_ids = set(exclude_media_ids)
+        if with_children_data and expand_children and 'children' not in fields:
+            fields = f'{fields},children{{{self._ALL_CHILDREN_MEDIA_FIELDS}}}'
+        url = f'{self._BASE_API_PATH}/{self._API_VERSION}/{self._user_id}/media?access_token={self._access_token}&fields={fields}&since={since if since else ""}&until={until if until else ""}'
+
+        async for media in self._iter_pages(url, 'media'):
+            if media['id'] in exclude_media_ids or media.get('media_type') == 'VIDEO':
+                continue
+
+            if with_children_data and media.get('media_type') == 'CAROUSEL_ALBUM':
+                media['children'] = await self._carousel_children(media)
+            else:
+                media.pop('children', None)
+
+            yield InstagramMedia(media)
+
+    async def get_user_medias(self, since: int = None, until: int = None, fields=_ALL_MEDIA_FIELDS, with_children_data=False, exclude_media_ids=[], expand_children=True):
+        return [media async for media in self.iter_user_medias(since, until, fields, with_children_data, exclude_media_ids, expand_children)]
+
+    async def _carousel_children(self, media):
+        expanded_children = media.get('children')
+        if not isinstance(expanded_children, dict):
+            return await self.get_media_children(media['id'])
+
+        children_data = list(expanded_children.get('data', []))
+        next_url = expanded_children.get('paging', {}).get('next')
+        if next_url:
+            children_data.extend([child async for child in self._iter_pages(next_url, 'media children')])
+
+        return [child for child in children_data if InstagramClient._is_supported_child(child)]
+
+    async def iter_media_children(self, media_id, fields=_ALL_CHILDREN_MEDIA_FIELDS):
+        url = f'{self._BASE_API_PATH}/{self._API_VERSION}/{media_id}/children?access_token={self._access_token}&fields={fields}'
+
+        async for media in self._iter_pages(url, 'media children'):
+            if InstagramClient._is_supported_child(media):
+                yield InstagramMedia(media)
+
+    async def get_media_children(self, media_id, fields=_ALL_CHILDREN_MEDIA_FIELDS):
+        return [media async for media in self.iter_media_children(media_id, fields)]
+
+    async def download_media(self, media, destination_path):
+        file_path = None
+        async with self._semaphore:
+            response = await self._scheduler.request_async(self._session, 'GET', media, metrics=self.metrics, endpoint='media download')
+            async with response:
+                if response.status == 200:
+                    try:
+                        with open(f'{destination_path}', 'wb') as file:
+                            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                                file.write(chunk)
+                            file_path = file.name
+                    except BaseException:  # includes the cancellation of the upload task, a partial file would be left behind.
+                        os.remove(destination_path)
+                        raise
+                    print(f'Image downloaded to {destination_path}')
+
+        return file_path
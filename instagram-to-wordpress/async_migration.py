@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import os
+from collections import deque
+from datetime import datetime
+from dotenv import load_dotenv
+from async_instagram_client import AsyncInstagramClient
+from async_wordpress_client import AsyncWordpressClient
+from image_transcoder import ImageTranscoder, TranscodeOptions
+from instagram_client import InstagramMedia
+from migration_pipeline import DOWNLOAD_DIR, ledger_resume_point, local_media_path, post_details, post_images
+from request_metrics import write_metrics
+from request_scheduler import scheduler_from_env
+from sync_ledger import SyncLedger
+from taxonomy_cache import TermCache
+from token_store import TokenStore
+
+
+async def _upload_image(instagram_client: AsyncInstagramClient, wordpress_client: AsyncWordpressClient, image: InstagramMedia, title, download_dir,
+                        transcoder: ImageTranscoder = None, ledger: SyncLedger = None):
+    if ledger is not None:
+        # Uploaded by an earlier run that stopped before the post was created (e.g. another image of the carousel failed).
+        media_id = await asyncio.to_thread(ledger.uploaded_image, image.id)
+        if media_id is not None:
+            print(f'Reusing WordPress media {media_id} already uploaded for Instagram media {image.id}')
+            return media_id
+
+    media_path = await instagram_client.download_media(image.media_url, local_media_path(image.media_url, download_dir))
+    try:
+        if transcoder is not None:
+            media_path = await asyncio.wrap_future(transcoder.submit(media_path))
+        media_data = await wordpress_client.upload_post_media(media_path, f'{title}', f'{title}', f'Media uploaded for post titled: {title}')
+        if ledger is not None:
+            await asyncio.to_thread(ledger.record_image_uploaded, image.id, media_data['id'])
+        return media_data['id']
+    finally:
+        os.remove(media_path)
+
+
+async def _upload_images(instagram_client: AsyncInstagramClient, wordpress_client: AsyncWordpressClient, media: InstagramMedia, download_dir,
+                         transcoder: ImageTranscoder = None, ledger: SyncLedger = None):
+    title = post_details(media)[0]
+    return await asyncio.gather(*[_upload_image(instagram_client, wordpress_client, image, title, download_dir, transcoder, ledger)
+                                  for image in post_images(media)])
+
+
+def _resolved(result):
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+async def migrate_medias_async(instagram_client: AsyncInstagramClient, wordpress_client: AsyncWordpressClient, medias,
+                               download_dir=DOWNLOAD_DIR, max_in_flight=32, ledger: SyncLedger = None,
+                               transcoder: ImageTranscoder = None):
+    # Same ordering guarantees as MediaMigrator.migrate_medias_pipelined: media of up to max_in_flight posts
+    # transfer concurrently (bounded by the clients' semaphores) while posts are created in `medias` order.
+    # Ledger writes (SQLite) run on a thread so they don't block the event loop.
+    os.makedirs(download_dir, exist_ok=True)
+    in_flight = deque()
+
+    async def create_oldest_post():
+        media, upload_task = in_flight.popleft()
+        media_ids = list(await upload_task)
+        if ledger is not None:
+            await asyncio.to_thread(ledger.record_media_uploaded, media.id, media_ids)
+
+        title, content, hashtags, timestamp = post_details(media)
+        post_json = await wordpress_client.create_post(title, content, categories=hashtags, tags=hashtags, date=timestamp, media_ids=media_ids)
+        if ledger is not None:
+            await asyncio.to_thread(ledger.record_post_created, media.id, post_json['id'])
+
+    try:
+        async for media in medias:
+            skip, media_ids = await asyncio.to_thread(ledger_resume_point, ledger, media)
+            if skip:
+                continue
+
+            if media_ids is not None:
+                upload_task = _resolved(media_ids)
+            else:
+                upload_task = asyncio.create_task(_upload_images(instagram_client, wordpress_client, media, download_dir, transcoder, ledger))
+            in_flight.append((media, upload_task))
+
+            if len(in_flight) >= max_in_flight:
+                await create_oldest_post()
+
+        while in_flight:
+            await create_oldest_post()
+    finally:
+        # Awaited once cancelled, so their downloads are cleaned up and their errors aren't left unretrieved.
+        for _, upload_task in in_flight:
+            upload_task.cancel()
+        await asyncio.gather(*[upload_task for _, upload_task in in_flight], return_exceptions=True)
+
+
+async def run_migration(args):
+    term_cache = TermCache(args.term_cache)
+    ledger = SyncLedger(args.ledger)
+    transcoder = ImageTranscoder(TranscodeOptions(args.max_dimension, args.image_format, args.quality), args.transcode_workers) if args.transcode else None
+    # Both clients share one rate limiter/retry scheduler, configured like the sync entry point's.
+    scheduler = scheduler_from_env()
+    async with AsyncInstagramClient('instagram_config.json', concurrency=args.concurrency, scheduler=scheduler,
+                                    base_api_path=os.environ.get('INSTAGRAM_API_BASE_URL')) as instagram_client, \
+            AsyncWordpressClient(os.environ['WORDPRESS_CLIENT_ID'], os.environ['WORDPRESS_CLIENT_SECRET'],
+                                 os.environ['WORDPRESS_USERNAME'], os.environ['WORDPRESS_APPLICATION_PASSWORD'], os.environ['WORDPRESS_SITE'],
+                                 term_cache=term_cache, concurrency=args.concurrency, scheduler=scheduler,
+                                 token_store=TokenStore(args.wordpress_token_cache),
+                                 base_api_path=os.environ.get('WORDPRESS_API_BASE_URL'),
+                                 oauth_token_url=os.environ.get('WORDPRESS_OAUTH_TOKEN_URL')) as wordpress_client:
+        if term_cache.is_empty():
+            await wordpress_client.warm_term_cache()
+
+        # Taken before paging, so posts published while the run is in progress are picked up by the next one.
+        cycle_started_at = int(datetime.now().timestamp())
+        instagram_posts = instagram_client.iter_user_medias(with_children_data=True, since=int(instagram_client.last_post_fetch_date),
+                                                            exclude_media_ids=await asyncio.to_thread(ledger.completed_media_ids))
+        try:
+            await migrate_medias_async(instagram_client, wordpress_client, instagram_posts, max_in_flight=args.max_in_flight, ledger=ledger,
+                                       transcoder=transcoder)
+        finally:
+            if transcoder is not None:
+                transcoder.shutdown()
+
+        # Updating the date the last post was fetched from Instagram, only once every post was created.
+        instagram_client.set_fetch_date(cycle_started_at)
+
+    write_metrics(args.metrics_json, args.metrics_prometheus, instagram_client.metrics, wordpress_client.metrics)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replicate Instagram posts into a WordPress site using asyncio clients.')
+    parser.add_argument('--concurrency', type=int, default=AsyncInstagramClient.DEFAULT_CONCURRENCY,
+                        help='Maximum concurrent requests per client.')
+    parser.add_argument('--max-in-flight', type=int, default=32,
+                        help='Maximum number of posts transferring media ahead of post creation.')
+    parser.add_argument('--term-cache', default=None,
+                        help='JSON file where WordPress category/tag ids are cached between runs.')
+    parser.add_argument('--ledger', default='sync_ledger.db',
+                        help='SQLite file recording the progress of every Instagram media, so an interrupted run resumes where it stopped.')
+    parser.add_argument('--wordpress-token-cache', default='wordpress_token.json',
+                        help='File where the WordPress access token is saved and reused between runs, renewed ahead of its expiration.')
+    parser.add_argument('--transcode', action='store_true',
+                        help='Resize and recompress downloaded images on a process pool before uploading them (requires Pillow).')
+    parser.add_argument('--max-dimension', type=int, default=2048,
+                        help='Longest side in pixels of transcoded images.')
+    parser.add_argument('--image-format', choices=['jpeg', 'webp'], default='jpeg',
+                        help='Format of transcoded images: progressive JPEG or WebP.')
+    parser.add_argument('--quality', type=int, default=85,
+                        help='Encoder quality (1-100) of transcoded images.')
+    parser.add_argument('--transcode-workers', type=int, default=None,
+                        help='Transcoding processes (defaults to the number of CPUs).')
+    parser.add_argument('--metrics-json', default=None,
+                        help='File where per endpoint request metrics of both clients are saved as JSON at the end of the run.')
+    parser.add_argument('--metrics-prometheus', default=None,
+                        help='File where per endpoint request metrics of both clients are saved in Prometheus text format.')
+    args = parser.parse_args()
+
+    load_dotenv()
+    required_env_keys = ['WORDPRESS_CLIENT_ID', 'WORDPRESS_CLIENT_SECRET',
+                         'WORDPRESS_USERNAME', 'WORDPRESS_APPLICATION_PASSWORD', 'WORDPRESS_SITE']
+    if any(env_key not in os.environ for env_key in required_env_keys):
+        print(f'Missing one of the environment variables required for authentication {required_env_keys}')
+        exit(1)
+
+    asyncio.run(run_migration(args))
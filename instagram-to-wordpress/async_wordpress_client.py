@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+import aiohttp
+from datetime import datetime
+from request_metrics import RequestMetrics
+from request_scheduler import RequestScheduler, get_shared_scheduler
+from taxonomy_cache import TermCache
+from token_store import TokenStore
+from wordpress_client import WordpressClient
+
+
+class AsyncWordpressClient():
+    _client_id: str
+    _client_secret: str
+    _username: str
+    _application_password: str
+    _site: str
+    _access_token: str
+    _session: aiohttp.ClientSession
+    _owns_session: bool
+    _term_cache: TermCache
+    _concurrency: int
+    _semaphore: asyncio.Semaphore
+    _auth_lock: asyncio.Lock
+    _scheduler: RequestScheduler
+    metrics: RequestMetrics
+    _token_store: TokenStore
+    _expiration_date: float
+    DEFAULT_CONCURRENCY = 16
+    _BASE_API_PATH = WordpressClient._BASE_API_PATH
+    _OAUTH_TOKEN_URL = WordpressClient._OAUTH_TOKEN_URL
+
+    def __init__(self, client_id, client_secret, username, application_password, site, session: aiohttp.ClientSession = None,
+                 term_cache: TermCache = None, concurrency=DEFAULT_CONCURRENCY, scheduler: RequestScheduler = None,
+                 base_api_path=None, oauth_token_url=None, metrics: RequestMetrics = None,
+                 token_store: TokenStore = None):
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._username = username
+        self._application_password = application_password
+        self._site = site
+        self._access_token = None
+        self._expiration_date = None
+        self._session = session
+        self._owns_session = session is None
+        self._term_cache = term_cache if term_cache else TermCache()
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._auth_lock = asyncio.Lock()
+        self._scheduler = scheduler if scheduler else get_shared_scheduler()
+        self.metrics = metrics if metrics else RequestMetrics('wordpress')
+        if base_api_path:
+            self._BASE_API_PATH = base_api_path
+        if oauth_token_url:
+            self._OAUTH_TOKEN_URL = oauth_token_url
+        self._token_store = token_store if token_store else TokenStore()
+        for api_url in [self._BASE_API_PATH, self._OAUTH_TOKEN_URL]:
+            self._scheduler.limit_api_host(api_url)
+
+    async def __aenter__(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self._concurrency))
+        self._access_token, self._expiration_date = self._token_store.load(self._token_identity(), WordpressClient.TOKEN_REFRESH_MARGIN)
+        if self._access_token is None:
+            await self._authenticate_user()
+        else:
+            print('Reusing saved Wordpress access token.')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._owns_session:
+            await self._session.close()
+
+    @property
+    def auth_header(self):
+        return {'Authorization': f'Bearer {self._access_token}'}
+
+    @staticmethod
+    def _form(data):
+        # Same encoding as requests: values are stringified and None values are left out.
+        return {key: str(value) for key, value in data.items() if value is not None}
+
+    def _token_identity(self):
+        return WordpressClient.token_identity(self._OAUTH_TOKEN_URL, self._client_id, self._username, self._site)
+
+    def _token_expiring(self):
+        return self._expiration_date is not None and self._expiration_date - datetime.now().timestamp() <= WordpressClient.TOKEN_REFRESH_MARGIN
+
+    async def _refresh_token(self, stale_token):
+        # Many tasks may hit a 401 at once, only the first one re-authenticates.
+        async with self._auth_lock:
+            if self._access_token == stale_token:
+                print('Access token will be renewed.')
+                await self._authenticate_user()
+
+    async def _authenticate_user(self):
+        # Not bounded by the semaphore: it runs while requests that hit a 401 still hold their slots.
+        token_response = await self._scheduler.request_async(self._session, 'POST', self._OAUTH_TOKEN_URL,
+                                                             metrics=self.metrics, endpoint='oauth token',
+                                                             data={'client_id': self._client_id, 'client_secret': self._client_secret,
+                                                                   'grant_type': 'password', 'username': self._username,
+                                                                   'password': self._application_password})
+        async with token_response:
+            token_json = await token_response.json(content_type=None)
+
+        if token_response.status != 200:
+            print(f'Error while trying to authenticate [{token_response.url}]: {token_json}')
+            exit(1)
+
+        required_keys = ['access_token']
+        if any(key not in token_json for key in required_keys):
+            print(f'Missing one or more required keys ({required_keys}) from response of token request')
+            exit(1)
+        self._access_token = token_json['access_token']
+        self._expiration_date = datetime.now().timestamp() + token_json['expires_in'] if 'expires_in' in token_json else None
+        self._token_store.save(self._token_identity(), self._access_token, self._expiration_date)
+
+    async def _request(self, method, path, build_body=None, params=None):
+        # build_body returns (body kwargs, cleanup) per attempt, as request bodies (e.g. multipart files) can't be sent twice.
+        if self._token_expiring():
+            await self._refresh_token(self._access_token)
+        access_token = self._access_token
+
+        async def reauthorize():
+            await self._refresh_token(access_token)
+            return self.auth_header
+
+        async with self._semaphore:
+            response = await self._scheduler.request_async(self._session, method, f'{self._BASE_API_PATH}/{self._site}/{path}',
+                                                           on_unauthorized=reauthorize, build_body=build_body,
+                                                           metrics=self.metrics, endpoint=f'{method} {path}',
+                                                           headers={'Authorization': f'Bearer {access_token}'}, params=params)
+            async with response:
+                return response, await response.json(content_type=None), response.headers
+
+    async def upload_post_media(self, file_path, caption, alt_text, description, post_id = None):
+        def build_body():
+            file = open(file_path, 'rb')
+            form = aiohttp.FormData(self._form({'date': datetime.now(), 'alt_text': alt_text, 'caption': caption,
+                                                'description': description, 'post': post_id if post_id else 0}))
+            form.add_field('file', file, filename=os.path.basename(file_path))
+            return {'data': form}, file.close
+
+        media_response, media_json, _ = await self._request('POST', 'media', build_body)
+
+        if media_response.status not in [200, 201]:
+            print(f'Error while trying to upload media [{media_response.url}]: {media_json}')
+            exit(1)
+
+        print(f'Media uploaded: {media_json["id"]}')
+        return media_json
+
+    async def create_post(self, title, content, categories = [], tags=[], date = None, author = None, post_medias_path = [], media_ids = []):
+        media_ids = list(media_ids)
+        uploaded = await asyncio.gather(*[self.upload_post_media(media_path, f'{title}', f'{title}', f'Media uploaded for post titled: {title}')
+                                          for media_path in post_medias_path])
+        media_ids.extend(media_data['id'] for media_data in uploaded)
+
+        # Create a gallery with the uploaded media IDs
+        gallery_shortcode = f'[gallery ids="{",".join(map(str, media_ids))}"]'
+        content = f'{gallery_shortcode}{content}'  # add the gallery to the post content
+        category_ids, tag_ids = await asyncio.gather(
+            asyncio.gather(*[self.retrieve_or_create_category_id(category) for category in categories]),
+            asyncio.gather(*[self.retrieve_or_create_tag_id(tag) for tag in tags]))
+        post_data = self._form({'date': date if date else datetime.now(), 'status': 'publish', 'format': 'standard',
+                                'title': title, 'content': content, 'comment_status': 'open',
+                                'author': await self.get_author_id(author) if author else None,
+                                'categories': ','.join(dict.fromkeys(map(str, category_ids))),
+                                'tags': ','.join(dict.fromkeys(map(str, tag_ids)))})
+        post_response, post_json, _ = await self._request('POST', 'posts', lambda: ({'data': post_data}, None))
+
+        if post_response.status not in [200, 201]:
+            print(f'Error while trying to create post [{post_response.url}]: {post_json}')
+            exit(1)
+
+        print(f'Post created: {post_json["id"]}')
+        return post_json
+
+    async def get_author_id(self, author):
+        author_response, author_json, _ = await self._request('GET', 'users', params={'search': author})
+
+        if author_response.status != 200:
+            print(f'Error while trying to retrieve author [{author_response.url}]: {author_json}')
+            exit(1)
+
+        if len(author_json) == 0:
+            print(f'Could not find author matching string: {author_json}')
+            exit(1)
+
+        return author_json[0]['id']
+
+    async def warm_term_cache(self, per_page=100):
+        for taxonomy in TermCache.TAXONOMIES:
+            page = 1
+            total_pages = 1
+            while page <= total_pages:
+                terms_response, terms_json, terms_headers = await self._request(
+                    'GET', taxonomy, params={'per_page': per_page, 'page': page, '_fields': 'id,name,slug'})
+
+                if terms_response.status != 200:
+                    print(f'Error while trying to list {taxonomy} [{terms_response.url}]: {terms_json}')
+                    exit(1)
+
+                self._term_cache.add(taxonomy, terms_json, persist=False)
+                total_pages = int(terms_headers.get('X-WP-TotalPages', page))
+                page += 1
+        self._term_cache.save()
+
+    async def _retrieve_or_create_term_id(self, taxonomy, name):
+        term_id = await self._get_term_id(taxonomy, name)
+        if term_id is not None:
+            return term_id
+
+        # New term, so create it.
+        term_response, term_json, _ = await self._request('POST', taxonomy, lambda: ({'data': {'name': name}}, None))
+
+        if term_response.status == 400 and term_json.get('code') == 'term_exists':
+            term_id = term_json['data']['term_id']
+            self._term_cache.add(taxonomy, [{'id': term_id, 'name': name}])
+            return term_id
+
+        if term_response.status not in [200, 201]:
+            print(f'Error while trying to create {taxonomy} [{term_response.url}]: {term_json}')
+            exit(1)
+
+        print(f'Term created ({taxonomy}): {term_json["id"]} {term_json.get("name", name)}')
+        self._term_cache.add(taxonomy, [term_json])
+        return term_json['id']
+
+    async def _get_term_id(self, taxonomy, name):
+        term_id = self._term_cache.get(taxonomy, name)
+        if term_id is not None:
+            return term_id
+
+        term_response, term_json, _ = await self._request('GET', taxonomy, params={'search': name, 'per_page': 100})
+
+        if term_response.status != 200:
+            print(f'Error while trying to retrieve {taxonomy} [{term_response.url}]: {term_json}')
+            exit(1)
+
+        self._term_cache.add(taxonomy, term_json)
+        return self._term_cache.get(taxonomy, name)
+
+    async def retrieve_or_create_category_id(self, category):
+        return await self._retrieve_or_create_term_id('categories', category)
+
+    async def get_category_id(self, category):
+        return await self._get_term_id('categories', category)
+
+    async def retrieve_or_create_tag_id(self, tag):
+        return await self._retrieve_or_create_term_id('tags', tag)
+
+    async def get_tag_id(self, tag):
+        return await self._get_term_id('tags', tag)
@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+GRAPH_API_VERSION = 'v19.0'
+PAGE_SIZE = 25
+
+
+class ServerStats():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, endpoint, status, bytes_in, bytes_out):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def to_dict(self):
+        with self._lock:
+            # Sub-requests of a batch call are tallied apart (batched_*), they aren't HTTP requests of their own.
+            return {'requests': dict(self.requests),
+                    'total_requests': sum(count for endpoint, count in self.requests.items() if not endpoint.startswith('batched_')),
+                    'statuses': {str(status): count for status, count in self.statuses.items()},
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+class MockBehavior():
+    # Knobs shared by both stand-ins: injected latency and a fraction of requests answered with 429.
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def should_rate_limit(self):
+        with self._lock:
+            return self._random.random() < self.rate_limit_ratio
+
+
+class SyntheticAccount():
+    # Deterministic Instagram account: newest media first, every carousel_every-th media is a carousel.
+    HASHTAGS = [f'tag{index}' for index in range(40)]
+
+    def __init__(self, posts=100, carousel_every=3, children=4, image_size=200 * 1024, hashtags_per_post=5, videos_every=0):
+        self.posts = posts
+        self.carousel_every = carousel_every
+        self.children = children
+        self.image_size = image_size
+        self.hashtags_per_post = hashtags_per_post
+        self.videos_every = videos_every
+        self._started_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def media_ids(self):
+        return [f'{index}' for index in reversed(range(self.posts))]
+
+    def media_type(self, media_id):
+        index = int(media_id)
+        if self.videos_every and index % self.videos_every == self.videos_every - 1:
+            return 'VIDEO'
+        if self.carousel_every and index % self.carousel_every == 0:
+            return 'CAROUSEL_ALBUM'
+        return 'IMAGE'
+
+    def children_ids(self, media_id):
+        return [f'{media_id}{child:03d}' for child in range(self.children)] if self.media_type(media_id) == 'CAROUSEL_ALBUM' else []
+
+    def media_json(self, media_id, base_url, fields):
+        index = int(media_id)
+        timestamp = (self._started_at + timedelta(hours=index)).strftime('%Y-%m-%dT%H:%M:%S+0000')
+        hashtags = [self.HASHTAGS[(index + offset) % len(self.HASHTAGS)] for offset in range(self.hashtags_per_post)]
+        # Media are served under another host name, like Instagram's CDN, so they get their own connection pool and no API rate limit.
+        cdn_url = f'http://localhost:{urlsplit(base_url).port}'
+        media_json = {'id': media_id, 'media_type': self.media_type(media_id), 'permalink': f'{base_url}/p/{media_id}',
+                      'media_url': f'{cdn_url}/cdn/{media_id}.jpg?token=abc', 'username': 'benchmark', 'timestamp': timestamp,
+                      'caption': f'Synthetic post {index} ' + ' '.join(f'#{hashtag}' for hashtag in hashtags)}
+        return {key: value for key, value in media_json.items() if key in fields}
+
+    def image_bytes(self, name):
+        # Stable content per image name, so hashes (and de-duplication) behave like real media.
+        seed = hashlib.sha256(name.encode()).digest()
+        return (seed * (self.image_size // len(seed) + 1))[:self.image_size]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse shows in the numbers.
+    disable_nagle_algorithm = True  # headers and body are separate writes, Nagle would hold the body back on a reused connection.
+    stats: ServerStats
+    behavior: MockBehavior
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, endpoint, status, body, content_type='application/json', headers={}, bytes_in=0):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.stats.record(endpoint, status, bytes_in, len(body))
+
+    def _handle(self, method):
+        body = self._read_body() if method in ['POST', 'PUT'] else b''
+        url = urlsplit(self.path)
+        endpoint, handler = self.route(method, url.path)
+        time.sleep(self.behavior.latency)
+        if endpoint is None:
+            return self._send('unknown', 404, {'error': f'No route for {method} {url.path}'}, bytes_in=len(body))
+        if self.behavior.should_rate_limit():
+            return self._send(endpoint, 429, {'error': 'rate limited'}, headers={'Retry-After': str(self.behavior.retry_after)}, bytes_in=len(body))
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        status, response_body, content_type, headers = handler(query, body)
+        self._send(endpoint, status, response_body, content_type, headers, bytes_in=len(body))
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class GraphApiHandler(_StubHandler):
+    # Instagram Graph API + CDN stand-in: paged media listing, children (inline or edge) and image bytes.
+    account: SyntheticAccount
+
+    def route(self, method, path):
+        base_url = f'http://{self.headers["Host"]}'
+        if method == 'GET' and path == '/refresh_access_token':
+            return 'refresh_access_token', lambda query, body: (200, {'access_token': 'benchmark', 'expires_in': 60 * 24 * 60 * 60}, 'application/json', {})
+        if method == 'GET' and path.startswith('/cdn/'):
+            name = path.split('/')[-1]
+            return 'cdn', lambda query, body: (200, self.account.image_bytes(name), 'image/jpeg', {})
+        match = re.fullmatch(rf'/{GRAPH_API_VERSION}/([^/]+)/media', path)
+        if method == 'GET' and match:
+            return 'media', lambda query, body: self._media_page(base_url, path, query)
+        match = re.fullmatch(rf'/{GRAPH_API_VERSION}/([^/]+)/children', path)
+        if method == 'GET' and match:
+            return 'children', lambda query, body: self._children_page(base_url, path, match.group(1), query)
+        return None, None
+
+    def _page(self, items, base_url, path, query):
+        offset = int(query.get('after', 0))
+        response_json = {'data': items[offset:offset + PAGE_SIZE]}
+        if offset + PAGE_SIZE < len(items):
+            response_json['paging'] = {'next': f'{base_url}{path}?{urlencode({**query, "after": offset + PAGE_SIZE})}'}
+        return response_json
+
+    def _children_fields(self, fields):
+        match = re.search(r'children\{([^}]*)\}', fields)
+        return match.group(1).split(',') if match else None
+
+    def _media_page(self, base_url, path, query):
+        fields = query.get('fields', '')
+        children_fields = self._children_fields(fields)
+        top_fields = re.sub(r'children\{[^}]*\}', '', fields).split(',')
+        page = self._page(self.account.media_ids(), base_url, path, query)
+        data = []
+        for media_id in page['data']:
+            media_json = self.account.media_json(media_id, base_url, top_fields)
+            children_ids = self.account.children_ids(media_id)
+            if children_fields is not None and children_ids:
+                media_json['children'] = {'data': [self.account.media_json(child_id, base_url, children_fields) | {'media_type': 'IMAGE'}
+                                                   for child_id in children_ids]}
+            data.append(media_json)
+        page['data'] = data
+        return 200, page, 'application/json', {'X-App-Usage': json.dumps({'call_count': 10, 'total_time': 5, 'total_cputime': 5})}
+
+    def _children_page(self, base_url, path, media_id, query):
+        fields = query.get('fields', '').split(',')
+        page = self._page(self.account.children_ids(media_id), base_url, path, query)
+        page['data'] = [self.account.media_json(child_id, base_url, fields) | {'media_type': 'IMAGE'} for child_id in page['data']]
+        return 200, page, 'application/json', {}
+
+
+class WordpressApiHandler(_StubHandler):
+    # WordPress REST stand-in: OAuth token, term search/create/list, media upload/list, posts, users and /batch/v1.
+    store: dict
+    store_lock: threading.Lock
+    batch_enabled: bool
+
+    def route(self, method, path):
+        if method == 'POST' and path == '/oauth2/token':
+            return 'oauth2_token', lambda query, body: (200, {'access_token': f'benchmark-{self._next_id()}', 'token_type': 'bearer'}, 'application/json', {})
+        if method == 'POST' and self.batch_enabled and re.fullmatch(r'/wp/v2/sites/[^/]+/batch/v1', path):
+            return 'batch', lambda query, body: self._batch(body)
+        match = re.fullmatch(r'/wp/v2/sites/[^/]+/(categories|tags|media|posts|users)', path)
+        if not match:
+            return None, None
+        collection = match.group(1)
+        if method == 'GET':
+            return f'{collection}_list', lambda query, body: self._list(collection, query)
+        if method == 'POST' and collection in ['categories', 'tags']:
+            return f'{collection}_create', lambda query, body: self._create_term(collection, body)
+        if method == 'POST' and collection in ['media', 'posts']:
+            return f'{collection}_create', lambda query, body: self._create(collection, query, body)
+        return None, None
+
+    def _next_id(self):
+        with self.store_lock:
+            self.store['last_id'] += 1
+            return self.store['last_id']
+
+    def _list(self, collection, query):
+        with self.store_lock:
+            items = list(self.store[collection].values()) if collection != 'users' else [{'id': 1, 'name': 'benchmark'}]
+        if 'slug' in query:
+            slugs = [slug.lower() for slug in query['slug'].split(',')]
+            items = [item for item in items if item.get('slug') in slugs]
+        if 'search' in query:
+            items = [item for item in items if query['search'].lower() in item.get('name', '').lower()]
+        per_page = int(query.get('per_page', 10))
+        page = int(query.get('page', 1))
+        total_pages = max(1, (len(items) + per_page - 1) // per_page)
+        return 200, items[(page - 1) * per_page:page * per_page], 'application/json', {'X-WP-Total': str(len(items)), 'X-WP-TotalPages': str(total_pages)}
+
+    @staticmethod
+    def _fields(body):
+        # JSON (batch sub-requests, posts) or form encoded body.
+        if isinstance(body, dict):
+            return body
+        if body.startswith(b'{'):
+            return json.loads(body)
+        return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+
+    def _batch(self, body):
+        responses = []
+        for sub_request in json.loads(body)['requests']:
+            collection = sub_request['path'].split('/')[-1]
+            if sub_request['method'] != 'POST' or collection not in ['categories', 'tags', 'posts']:
+                responses.append({'status': 400, 'body': {'code': 'rest_batch_not_allowed'}, 'headers': {}})
+                continue
+            create = self._create_term if collection in ['categories', 'tags'] else lambda collection, body: self._create(collection, {}, body)
+            status, response_body, _, _ = create(collection, sub_request.get('body', {}))
+            self.stats.record(f'batched_{collection}_create', status, 0, 0)
+            responses.append({'status': status, 'body': response_body, 'headers': {}})
+        return 207, {'responses': responses}, 'application/json', {}
+
+    def _create_term(self, collection, body):
+        name = self._fields(body).get('name', '')
+        with self.store_lock:
+            existing = [term for term in self.store[collection].values() if term['name'].lower() == name.lower()]
+            if existing:
+                return 400, {'code': 'term_exists', 'data': {'status': 400, 'term_id': existing[0]['id']}}, 'application/json', {}
+            term = {'id': self._next_id(), 'name': name, 'slug': name.lower()}
+            self.store[collection][term['id']] = term
+        return 201, term, 'application/json', {}
+
+    def _create(self, collection, query, body):
+        with self.store_lock:
+            item = {'id': self._next_id()}
+            if collection == 'media':
+                item.update({'size': len(body), 'source_url': f'http://{self.headers["Host"]}/uploads/{item["id"]}.jpg'})
+            else:
+                item.update(self._fields(body))
+            self.store[collection][item['id']] = item
+        return 201, item, 'application/json', {}
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default backlog of 5 drops connections when the migration opens its pools at once.
+
+
+def _serve(handler_class, attributes):
+    handler = type(handler_class.__name__, (handler_class,), attributes)
+    server = _StubServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class MockServers():
+    def __init__(self, account: SyntheticAccount, behavior: MockBehavior = None, batch_enabled=True):
+        behavior = behavior if behavior else MockBehavior()
+        self.graph_stats = ServerStats()
+        self.wordpress_stats = ServerStats()
+        self.wordpress_store = {'last_id': 0, 'categories': {}, 'tags': {}, 'media': {}, 'posts': {}}
+        self._graph_server = _serve(GraphApiHandler, {'stats': self.graph_stats, 'behavior': behavior, 'account': account})
+        self._wordpress_server = _serve(WordpressApiHandler, {'stats': self.wordpress_stats, 'behavior': behavior,
+                                                              'store': self.wordpress_store, 'store_lock': threading.RLock(),
+                                                              'batch_enabled': batch_enabled})
+
+    @property
+    def instagram_base_url(self):
+        return f'http://127.0.0.1:{self._graph_server.server_port}'
+
+    @property
+    def wordpress_base_url(self):
+        return f'http://127.0.0.1:{self._wordpress_server.server_port}/wp/v2/sites'
+
+    @property
+    def wordpress_oauth_token_url(self):
+        return f'http://127.0.0.1:{self._wordpress_server.server_port}/oauth2/token'
+
+    def shutdown(self):
+        self._graph_server.shutdown()
+        self._wordpress_server.shutdown()
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from mock_servers import MockBehavior, MockServers, SyntheticAccount
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {'sync': os.path.join(SCRIPT_DIR, 'instagram-to-wordpress.py'),
+           'async': os.path.join(SCRIPT_DIR, 'async_migration.py')}
+
+
+def write_instagram_config(directory):
+    # Far-future expiration, so the token isn't refreshed and the run only measures the migration itself.
+    with open(os.path.join(directory, 'instagram_config.json'), 'w') as f:
+        json.dump({'user_id': 'benchmark', 'access_token': 'benchmark', 'last_post_fetch_date': 0,
+                   'expiration_date': (datetime.now() + timedelta(days=60)).timestamp()}, f)
+
+
+def migration_env(servers: MockServers):
+    return {**os.environ, 'WORDPRESS_CLIENT_ID': 'benchmark', 'WORDPRESS_CLIENT_SECRET': 'benchmark',
+            'WORDPRESS_USERNAME': 'benchmark', 'WORDPRESS_APPLICATION_PASSWORD': 'benchmark', 'WORDPRESS_SITE': 'benchmark.local',
+            'INSTAGRAM_API_BASE_URL': servers.instagram_base_url, 'WORDPRESS_API_BASE_URL': servers.wordpress_base_url,
+            'WORDPRESS_OAUTH_TOKEN_URL': servers.wordpress_oauth_token_url}
+
+
+def run_benchmark(args, script_args):
+    account = SyntheticAccount(posts=args.posts, carousel_every=args.carousel_every, children=args.children,
+                               image_size=args.image_size, hashtags_per_post=args.hashtags_per_post)
+    servers = MockServers(account, MockBehavior(latency=args.latency, rate_limit_ratio=args.rate_limit_ratio, retry_after=args.retry_after),
+                          batch_enabled=not args.no_batch)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            write_instagram_config(work_dir)
+            started_at = time.perf_counter()
+            completed = subprocess.run([sys.executable, SCRIPTS[args.script]] + script_args, cwd=work_dir, env=migration_env(servers),
+                                       stdout=None if args.verbose else subprocess.DEVNULL)
+            elapsed = time.perf_counter() - started_at
+    finally:
+        servers.shutdown()
+
+    if completed.returncode != 0:
+        print(f'Migration exited with status {completed.returncode}')
+        exit(1)
+
+    posts_created = len(servers.wordpress_store['posts'])
+    graph_stats = servers.graph_stats.to_dict()
+    wordpress_stats = servers.wordpress_stats.to_dict()
+    total_requests = graph_stats['total_requests'] + wordpress_stats['total_requests']
+    return {'script': args.script, 'script_args': script_args, 'posts': args.posts, 'posts_created': posts_created,
+            'media_uploaded': len(servers.wordpress_store['media']), 'elapsed_seconds': round(elapsed, 3),
+            'posts_per_second': round(posts_created / elapsed, 3) if elapsed else None,
+            'requests_per_post': round(total_requests / posts_created, 2) if posts_created else None,
+            'bytes_downloaded': graph_stats['bytes_out'] + wordpress_stats['bytes_out'],
+            'bytes_uploaded': graph_stats['bytes_in'] + wordpress_stats['bytes_in'],
+            # ru_maxrss is in kilobytes on Linux, and only covers the (single) migration child that was waited on.
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'graph_api': graph_stats, 'wordpress_api': wordpress_stats}
+
+
+def print_report(report):
+    print(f'Script: {report["script"]} {" ".join(report["script_args"])}')
+    print(f'Posts created: {report["posts_created"]}/{report["posts"]} ({report["media_uploaded"]} media) in {report["elapsed_seconds"]}s')
+    print(f'Posts/sec: {report["posts_per_second"]}')
+    print(f'Requests/post: {report["requests_per_post"]}')
+    print(f'Bytes downloaded: {report["bytes_downloaded"]}, bytes uploaded: {report["bytes_uploaded"]}')
+    print(f'Peak RSS: {report["peak_rss_kb"] / 1024:.1f} MB')
+    for api in ['graph_api', 'wordpress_api']:
+        print(f'{api} requests: {report[api]["requests"]} statuses: {report[api]["statuses"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark a migration against local Instagram Graph API and WordPress REST stand-ins. '
+                                                 'Arguments after -- are passed to the migration script.')
+    parser.add_argument('--script', choices=SCRIPTS.keys(), default='sync',
+                        help='Migration entry point to run: instagram-to-wordpress.py (sync) or async_migration.py (async).')
+    parser.add_argument('--posts', type=int, default=100, help='Number of posts in the synthetic Instagram account.')
+    parser.add_argument('--carousel-every', type=int, default=3, help='Every n-th post is a carousel (0 for none).')
+    parser.add_argument('--children', type=int, default=4, help='Images per carousel.')
+    parser.add_argument('--image-size', type=int, default=200 * 1024, help='Size in bytes of every image served by the CDN stand-in.')
+    parser.add_argument('--hashtags-per-post', type=int, default=5, help='Hashtags in every caption (each becomes a category and a tag).')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every stand-in response.')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='Fraction of requests answered with a 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent along with every 429.')
+    parser.add_argument('--no-batch', action='store_true', help='Answer /batch/v1 with a 404, like sites without batch support.')
+    parser.add_argument('--output', default=None, help='JSON file the report is written to.')
+    parser.add_argument('--verbose', action='store_true', help="Show the migration script's output.")
+    args, script_args = parser.parse_known_args()
+    script_args = [arg for arg in script_args if arg != '--']
+
+    report = run_benchmark(args, script_args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
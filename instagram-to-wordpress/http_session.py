@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class StreamingBody():
+    # Iterable request body; a known length is sent as Content-Length, otherwise requests falls back to chunked encoding.
+    def __init__(self, chunks, length=0):
+        self._chunks = chunks
+        self._length = length
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def __len__(self):
+        return self._length
+
+
+class PooledSession(requests.Session):
+    DEFAULT_POOL_CONNECTIONS = 10
+    DEFAULT_POOL_MAXSIZE = 10
+    DEFAULT_TIMEOUT = (5, 60)  # (connect, read) in seconds.
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, timeout=DEFAULT_TIMEOUT, pool_block=False):
+        super().__init__()
+        self.timeout = timeout
+        # Same adapter for both schemes so every host gets its own keep-alive pool.
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        # requests has no session-wide timeout, so it's applied here unless the call site sets its own.
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_shared_session: PooledSession = None
+
+
+def get_shared_session():
+    global _shared_session
+    if _shared_session is None:
+        _shared_session = PooledSession()
+    return _shared_session
+
+
+def session_from_env(workers=1):
+    # Pool settings shared by every entry point, sized for the download and upload workers unless HTTP_POOL_MAXSIZE is set.
+    return PooledSession(pool_maxsize=int(os.environ.get('HTTP_POOL_MAXSIZE', max(PooledSession.DEFAULT_POOL_MAXSIZE, 2 * workers))),
+                         timeout=(float(os.environ.get('HTTP_CONNECT_TIMEOUT', PooledSession.DEFAULT_TIMEOUT[0])),
+                                  float(os.environ.get('HTTP_READ_TIMEOUT', PooledSession.DEFAULT_TIMEOUT[1]))))
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is only needed when transcoding is enabled.
+    Image = None
+
+
+class TranscodeOptions():
+    FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+    def __init__(self, max_dimension=2048, image_format='JPEG', quality=85):
+        self.max_dimension: int = max_dimension
+        self.image_format: str = image_format.upper()
+        self.quality: int = quality
+
+
+def transcode_image(media_path, options: TranscodeOptions):
+    # Runs in a worker process: resizes, re-encodes (progressive JPEG or WebP) and drops EXIF/XMP metadata.
+    # Returns the path of whichever file is smaller, the other one is removed.
+    output_path = os.path.splitext(media_path)[0] + '.transcoded' + TranscodeOptions.FORMAT_EXTENSIONS[options.image_format]
+    try:
+        with Image.open(media_path) as image:
+            image = ImageOps.exif_transpose(image)  # orientation is applied to the pixels, as the EXIF tag is dropped.
+            image.thumbnail((options.max_dimension, options.max_dimension), Image.Resampling.LANCZOS)
+            if options.image_format == 'JPEG' and image.mode not in ['RGB', 'L']:
+                image = image.convert('RGB')
+            save_options = {'quality': options.quality, 'icc_profile': image.info.get('icc_profile')}
+            if options.image_format == 'JPEG':
+                save_options.update({'progressive': True, 'optimize': True})
+            else:
+                save_options.update({'method': 4})
+            image.save(output_path, options.image_format, **save_options)
+    except (OSError, ValueError) as err:
+        print(f'Could not transcode {media_path}, uploading it unchanged: {err}')
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return media_path
+
+    original_size = os.path.getsize(media_path)
+    transcoded_size = os.path.getsize(output_path)
+    if transcoded_size >= original_size:
+        os.remove(output_path)
+        return media_path
+
+    os.remove(media_path)
+    print(f'Image transcoded to {output_path} ({original_size} -> {transcoded_size} bytes)')
+    return output_path
+
+
+class ImageTranscoder():
+    # Process pool so recompression uses every core without holding up the download/upload threads.
+    options: TranscodeOptions
+    pool: ProcessPoolExecutor
+
+    def __init__(self, options: TranscodeOptions = None, workers=None):
+        if Image is None:
+            print('Pillow is required to transcode images (pip install Pillow)')
+            exit(1)
+        if options is not None and options.image_format not in TranscodeOptions.FORMAT_EXTENSIONS:
+            print(f'Unsupported transcoding format {options.image_format}, use one of {list(TranscodeOptions.FORMAT_EXTENSIONS)}')
+            exit(1)
+
+        self.options = options if options else TranscodeOptions()
+        # The migration scripts run at import time, so workers are forked (spawned ones would re-run them) and
+        # all started now, before the download/upload threads exist.
+        workers = workers if workers else os.cpu_count()
+        mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        for started in [self.pool.submit(os.getpid) for _ in range(workers)]:
+            started.result()
+
+    def submit(self, media_path) -> Future:
+        return self.pool.submit(transcode_image, media_path, self.options)
+
+    def transcode(self, media_path):
+        return self.submit(media_path).result()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
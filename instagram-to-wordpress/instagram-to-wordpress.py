@@ -1,12 +1,74 @@
 #!/usr/bin/python3
 
-import re
+import argparse
 from instagram_client import InstagramClient
 from wordpress_client import WordpressClient
+from http_session import session_from_env
+from request_scheduler import scheduler_from_env
+from taxonomy_cache import TermCache
+from token_store import TokenStore
+from media_index import MediaIndex
+from migration_pipeline import MediaMigrator
+from image_transcoder import ImageTranscoder, TranscodeOptions
+from sync_ledger import SyncLedger
+from request_metrics import write_metrics
+from sync_daemon import BackgroundTokenRefresher, watch
+from tracing import ThreadProfiler, Tracer
 import os
 from dotenv import load_dotenv
 from datetime import datetime
 
+parser = argparse.ArgumentParser(description='Replicate Instagram posts into a WordPress site.')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Worker threads per stage (download/upload). More than 1 enables the pipelined migration.')
+parser.add_argument('--max-in-flight', type=int, default=8,
+                    help='Maximum number of posts downloading/uploading ahead of post creation in pipelined mode.')
+parser.add_argument('--term-cache', default=None,
+                    help='JSON file where WordPress category/tag ids are cached between runs.')
+parser.add_argument('--stream', action='store_true',
+                    help='Pipe Instagram media straight into the WordPress upload instead of going through temporary files.')
+parser.add_argument('--media-index', default=None,
+                    help='SQLite file mapping Instagram media and content hashes to WordPress media, so nothing is uploaded twice.')
+parser.add_argument('--rebuild-media-index', action='store_true',
+                    help="Index the WordPress site's existing media library into --media-index before migrating.")
+parser.add_argument('--ledger', default='sync_ledger.db',
+                    help='SQLite file recording the progress of every Instagram media, so an interrupted run resumes where it stopped.')
+parser.add_argument('--transcode', action='store_true',
+                    help='Resize and recompress downloaded images on a process pool before uploading them (requires Pillow).')
+parser.add_argument('--max-dimension', type=int, default=2048,
+                    help='Longest side in pixels of transcoded images.')
+parser.add_argument('--image-format', choices=['jpeg', 'webp'], default='jpeg',
+                    help='Format of transcoded images: progressive JPEG or WebP.')
+parser.add_argument('--quality', type=int, default=85,
+                    help='Encoder quality (1-100) of transcoded images.')
+parser.add_argument('--transcode-workers', type=int, default=None,
+                    help='Transcoding processes (defaults to the number of CPUs).')
+parser.add_argument('--wordpress-token-cache', default='wordpress_token.json',
+                    help='File where the WordPress access token is saved and reused between runs, renewed ahead of its expiration.')
+parser.add_argument('--watch', action='store_true',
+                    help='Keep running and sync new posts every --poll-interval seconds, with clients, connections and caches kept warm.')
+parser.add_argument('--poll-interval', type=float, default=60,
+                    help='Seconds between two syncs in --watch mode.')
+parser.add_argument('--metrics-json', default=None,
+                    help='File where per endpoint request metrics of both clients are saved as JSON at the end of the run.')
+parser.add_argument('--metrics-prometheus', default=None,
+                    help='File where per endpoint request metrics of both clients are saved in Prometheus text format.')
+parser.add_argument('--trace', default=None,
+                    help='File where a timeline of the run (stages and client calls, per thread) is saved as Chrome trace JSON, for chrome://tracing or Perfetto.')
+parser.add_argument('--profile', default=None,
+                    help='File where a cProfile dump of the run (every thread) is saved, to find CPU hot spots.')
+args = parser.parse_args()
+if args.rebuild_media_index and not args.media_index:
+    parser.error('--rebuild-media-index requires --media-index')
+if args.transcode and args.stream:
+    parser.error('--transcode needs downloaded media, it cannot be combined with --stream')
+
+# Tracing and profiling are opt-in, a disabled tracer instruments nothing.
+tracer = Tracer(enabled=args.trace is not None)
+profiler = ThreadProfiler() if args.profile else None
+if profiler is not None:
+    profiler.enable()
+
 # Load environment variables
 load_dotenv()
 required_env_keys = ['WORDPRESS_CLIENT_ID', 'WORDPRESS_CLIENT_SECRET',
@@ -15,29 +77,77 @@ if any(env_key not in os.environ for env_key in required_env_keys):
     print(f'Missing one of the environment variables required for authentication {required_env_keys}')
     exit(1)
 
+# Both clients share one pooled keep-alive session, sized for the download and upload workers.
+http_session = session_from_env(args.workers)
+
+# Both clients share one rate limiter/retry scheduler (one token bucket per API host, media hosts are unthrottled).
+scheduler = scheduler_from_env()
+
 # Initialize Instagram and WordPress clients
-instagram_client = InstagramClient('instagram_config.json')
+term_cache = TermCache(args.term_cache)
+# API base URLs can be pointed to other servers (e.g. the benchmark stand-ins) through the environment.
+instagram_client = InstagramClient('instagram_config.json', session=http_session, scheduler=scheduler,
+                                   base_api_path=os.environ.get('INSTAGRAM_API_BASE_URL'))
 wordpress_client = WordpressClient(os.environ['WORDPRESS_CLIENT_ID'], os.environ['WORDPRESS_CLIENT_SECRET'],
-                                   os.environ['WORDPRESS_USERNAME'], os.environ['WORDPRESS_APPLICATION_PASSWORD'], os.environ['WORDPRESS_SITE'])
-
-# Fetch posts from Instagram
-instagram_posts = instagram_client.get_user_medias(with_children_data=True, since=int(instagram_client.last_post_fetch_date))
-
-# For each Instagram post, create a corresponding post on WordPress
-for media in instagram_posts:
-    timestamp = datetime.strptime(media.timestamp, '%Y-%m-%dT%H:%M:%S+0000')
-    title = timestamp.strftime('%d/%m/%Y %H:%M') # title for now is the formatted timestamp.
-    content = media.caption
-    hashtags = re.findall(r"#(\w+)", media.caption) # alll hashtags are treated as categories and tags.
-    media_paths = [instagram_client.download_media(media.media_url, f'./test/{media.media_url.split("/")[-1].split("?")[0]}')]
-
-    if len(media.children) > 0:
-        media_paths = [instagram_client.download_media(child_media.media_url, f'./test/{child_media.media_url.split("/")[-1].split("?")[0]}') for child_media in media.children]
-    
-    # Use hashtags as both tags and categories, date as the post date.
-    wordpress_client.create_post(title, content, categories=hashtags, tags=hashtags,date=timestamp, post_medias_path=media_paths)
-    for media_path in media_paths:
-        os.remove(media_path)
-
-# Updating the date the last post was fetched from Instagram
-instagram_client.set_fetch_date(int(datetime.now().timestamp()))
\ No newline at end of file
+                                   os.environ['WORDPRESS_USERNAME'], os.environ['WORDPRESS_APPLICATION_PASSWORD'], os.environ['WORDPRESS_SITE'],
+                                   session=http_session, term_cache=term_cache, scheduler=scheduler,
+                                   token_store=TokenStore(args.wordpress_token_cache),
+                                   base_api_path=os.environ.get('WORDPRESS_API_BASE_URL'), oauth_token_url=os.environ.get('WORDPRESS_OAUTH_TOKEN_URL'),
+                                   batch_url=os.environ.get('WORDPRESS_BATCH_URL'))
+tracer.instrument(instagram_client, 'instagram', ['iter_user_medias', 'get_user_medias', '_iter_pages', 'get_media_children', 'download_media',
+                                                  'open_media_stream'])
+tracer.instrument(wordpress_client, 'wordpress', ['warm_term_cache', 'resolve_term_ids', 'retrieve_or_create_category_id', 'retrieve_or_create_tag_id',
+                                                  'upload_post_media', 'upload_post_media_stream', 'create_post', 'create_posts', '_batch',
+                                                  '_authenticate_user'])
+if term_cache.is_empty():
+    wordpress_client.warm_term_cache()
+
+ledger = SyncLedger(args.ledger)
+media_index = MediaIndex(args.media_index) if args.media_index else None
+if args.rebuild_media_index:
+    with tracer.span('rebuild media index'):
+        media_index.rebuild(wordpress_client, http_session)
+
+transcoder = ImageTranscoder(TranscodeOptions(args.max_dimension, args.image_format, args.quality), args.transcode_workers) if args.transcode else None
+migrator = MediaMigrator(instagram_client, wordpress_client, stream=args.stream, media_index=media_index, ledger=ledger, transcoder=transcoder)
+tracer.instrument(migrator, 'migration', ['migrate_media', '_download_image', '_upload_downloaded_image', '_transfer_image', '_create_posts'])
+
+
+def sync_once():
+    cycle_started_at = int(datetime.now().timestamp())
+    # Fetch posts from Instagram, lazily page by page so posting starts with the first page.
+    # Media already posted by an earlier (possibly interrupted) run are left out.
+    instagram_posts = instagram_client.iter_user_medias(with_children_data=True, since=int(instagram_client.last_post_fetch_date),
+                                                        exclude_media_ids=ledger.completed_media_ids())
+
+    # For each Instagram post, create a corresponding post on WordPress
+    with tracer.span('sync cycle', workers=args.workers):
+        if args.workers > 1:
+            migrator.migrate_medias_pipelined(instagram_posts, workers=args.workers, max_in_flight=args.max_in_flight)
+        else:
+            migrator.migrate_medias(instagram_posts)
+
+    # Updating the date the last post was fetched from Instagram, only once every post was created.
+    # The cycle's start is used, so posts published while it ran are fetched by the next one (the ledger skips duplicates).
+    instagram_client.set_fetch_date(cycle_started_at)
+
+    write_metrics(args.metrics_json, args.metrics_prometheus, instagram_client.metrics, wordpress_client.metrics)
+
+
+# In watch mode clients, connections and caches stay warm between polls, and tokens are renewed in the background.
+token_refresher = BackgroundTokenRefresher([instagram_client, wordpress_client]) if args.watch else None
+try:
+    if args.watch:
+        token_refresher.start()
+        watch(sync_once, args.poll_interval)
+    else:
+        sync_once()
+finally:
+    if token_refresher is not None:
+        token_refresher.stop()
+    if transcoder is not None:
+        transcoder.shutdown()
+    if args.trace:
+        tracer.save(args.trace)
+    if profiler is not None:
+        profiler.dump(args.profile)
@@ -1,43 +1,77 @@
 #!/usr/bin/python3
 
-import array
 import io
 import json
-import requests
+import re
+import sys
+import threading
 from datetime import datetime, timedelta
+from http_session import STREAM_CHUNK_SIZE, PooledSession, get_shared_session
+from request_metrics import RequestMetrics
+from request_scheduler import RequestScheduler, get_shared_scheduler
 
 
 class InstagramMedia():
+    # Slotted (no per-instance __dict__) with the caption's hashtags and the timestamp parsed once, as a full-history
+    # export keeps thousands of these. Children are kept as the API returned them until first accessed.
+    __slots__ = ('id', 'media_type', 'permalink', 'media_url', 'thumbnail_url', 'caption', 'username', 'posted_at', 'hashtags',
+                 '_children')
+    _HASHTAG_PATTERN = re.compile(r'#(\w+)')
+
     def __init__(self, json_data):
         if 'id' not in json_data:
             raise RuntimeError('Missing ID on Instagram media json_data')
 
         self.id: str = json_data['id']
-        self.media_type: str = json_data['media_type'] if 'media_type' in json_data else ''
-        self.permalink: str = json_data['permalink'] if 'permalink' in json_data else ''
-        self.media_url: str = json_data['media_url'] if 'media_url' in json_data else ''
-        self.thumbnail_url: str = json_data['thumbnail_url'] if 'thumbnail_url' in json_data else ''
-        self.caption: str = json_data['caption'] if 'caption' in json_data else ''
-        self.username: str = json_data['username'] if 'username' in json_data else ''
-        self.timestamp: str = json_data['timestamp'] if 'timestamp' in json_data else ''
-        self.children: array = json_data['children'] if 'children' in json_data else []
+        self.media_type: str = sys.intern(json_data.get('media_type', ''))
+        self.permalink: str = json_data.get('permalink', '')
+        self.media_url: str = json_data.get('media_url', '')
+        self.thumbnail_url: str = json_data.get('thumbnail_url', '')
+        self.caption: str = json_data.get('caption', '')
+        self.username: str = sys.intern(json_data.get('username', ''))
+        # Instagram timestamps are UTC ('2024-01-02T03:04:05+0000'), kept naive like the post dates sent to WordPress.
+        self.posted_at: datetime = datetime.strptime(json_data['timestamp'], '%Y-%m-%dT%H:%M:%S%z').replace(tzinfo=None) if json_data.get('timestamp') else None
+        # Interned like media_type and username, the same values come back on most posts.
+        self.hashtags: tuple = tuple(sys.intern(hashtag) for hashtag in self._HASHTAG_PATTERN.findall(self.caption))
+        self._children: list = json_data.get('children') or ()  # shared empty tuple, most media have no children.
+
+    @property
+    def timestamp(self) -> str:
+        return f'{self.posted_at.isoformat()}+0000' if self.posted_at else ''
+
+    @property
+    def children(self) -> list:
+        # Raw children dicts become InstagramMedia on first access only, e.g. not for posts skipped thanks to the ledger.
+        if any(not isinstance(child, InstagramMedia) for child in self._children):
+            self._children = [child if isinstance(child, InstagramMedia) else InstagramMedia(child) for child in self._children]
+        return self._children
+
+    def to_dict(self):
+        return {'id': self.id, 'media_type': self.media_type, 'permalink': self.permalink, 'media_url': self.media_url,
+                'thumbnail_url': self.thumbnail_url, 'caption': self.caption, 'username': self.username, 'timestamp': self.timestamp,
+                'children': [child.to_dict() for child in self.children]}
 
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__)
+        return json.dumps(self.to_dict())
 
 
 class InstagramUser():
+    __slots__ = ('id', 'username', 'account_type', 'media_count')
+
     def __init__(self, json_data):
         if 'id' not in json_data:
             raise RuntimeError('Missing ID on Instagram user json_data')
 
         self.id: str = json_data['id']
-        self.username: str = json_data['username'] if 'username' in json_data else ''
-        self.account_type: str = json_data['account_type'] if 'account_type' in json_data else ''
-        self.media_count: int = json_data['media_count'] if 'media_count' in json_data else -1
+        self.username: str = json_data.get('username', '')
+        self.account_type: str = json_data.get('account_type', '')
+        self.media_count: int = json_data.get('media_count', -1)
+
+    def to_dict(self):
+        return {'id': self.id, 'username': self.username, 'account_type': self.account_type, 'media_count': self.media_count}
 
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__)
+        return json.dumps(self.to_dict())
 
 
 class InstagramClient():
@@ -46,13 +80,18 @@ class InstagramClient():
     _access_token: str
     _expiration_date: float
     _config_file: str
+    _session: PooledSession
+    _scheduler: RequestScheduler
+    metrics: RequestMetrics
+    _token_lock: threading.RLock
     _API_VERSION = 'v19.0'
     _ALL_CHILDREN_MEDIA_FIELDS = 'id,media_type,permalink,media_url,thumbnail_url,username,timestamp'
     _ALL_MEDIA_FIELDS = f'{_ALL_CHILDREN_MEDIA_FIELDS},caption'
     _ALL_USER_FIELDS = 'id,account_type,username,media_count'
     _BASE_API_PATH = 'https://graph.instagram.com'
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, session: PooledSession = None, scheduler: RequestScheduler = None, base_api_path=None,
+                 metrics: RequestMetrics = None):
         required_keys = ['user_id', 'access_token', 'expiration_date', 'last_post_fetch_date']
         f = open(config_file)
         config = json.load(f)
@@ -66,125 +105,162 @@ class InstagramClient():
         self._expiration_date = config['expiration_date']
         self.last_post_fetch_date = config['last_post_fetch_date'] if 'last_post_fetch_date' in config else 0
         self._config_file = config_file
-        self._refresh_token_if_needed()
-
-    def _refresh_token_if_needed(self):
-        now_timestamp = datetime.timestamp(datetime.now())
-        if self._expiration_date - now_timestamp <= 15 * 24 * 60 * 60:  # 15 days in seconds
-            print('Access token will be renewed.')
-            self._refresh_token()
+        self._session = session if session else get_shared_session()
+        self._scheduler = scheduler if scheduler else get_shared_scheduler()
+        self.metrics = metrics if metrics else RequestMetrics('instagram')
+        self._token_lock = threading.RLock()  # the token may be renewed from a background thread (watch mode).
+        if base_api_path:
+            self._BASE_API_PATH = base_api_path  # e.g. a local stand-in server for benchmarks.
+        self._scheduler.limit_api_host(self._BASE_API_PATH)  # media downloads from the CDN stay unthrottled.
+        self.refresh_token_if_needed()
+
+    def _get(self, url, endpoint, **kwargs):
+        # Rate limited per host and retried on 429/5xx by the scheduler, which records it in metrics under endpoint.
+        return self._scheduler.request(self._session, 'GET', url, metrics=self.metrics, endpoint=endpoint, **kwargs)
+
+    @staticmethod
+    def _redacted(url):
+        # Graph API URLs carry the access token, which must not end up in logs.
+        return re.sub(r'access_token=[^&]*', 'access_token=<redacted>', str(url))
+
+    def refresh_token_if_needed(self):
+        with self._token_lock:
+            now_timestamp = datetime.timestamp(datetime.now())
+            if self._expiration_date - now_timestamp <= 15 * 24 * 60 * 60:  # 15 days in seconds
+                print('Access token will be renewed.')
+                self._refresh_token()
 
     def _refresh_token(self):
         # 4. Call to refresh long-lived access-token.
-        long_lived_response = requests.get(
-            f'{self._BASE_API_PATH}/refresh_access_token?grant_type=ig_refresh_token&access_token={self._access_token}')
+        long_lived_response = self._get(
+            f'{self._BASE_API_PATH}/refresh_access_token?grant_type=ig_refresh_token&access_token={self._access_token}', 'refresh token')
         long_lived_json = long_lived_response.json()
 
         if long_lived_response.status_code != 200:
-            print(f'Error while trying to refresh authentication token [{long_lived_response.url}]: {long_lived_json}')
+            print(f'Error while trying to refresh authentication token [{self._redacted(long_lived_response.url)}]: {long_lived_json}')
             exit(1)
 
         required_keys = ['access_token', 'expires_in']
         if any(key not in long_lived_json for key in required_keys):
             print(f'Missing one or more required keys ({required_keys}) from response of long lived request: {long_lived_json}')
             exit(1)
-        print(f'Long Lived Token: {long_lived_json}')
+        print(f'Long lived token renewed, expires in {long_lived_json["expires_in"]} seconds')
         self._access_token = long_lived_json['access_token']
         time_change = timedelta(seconds=long_lived_json['expires_in'])
         self._expiration_date = datetime.timestamp(datetime.now() + time_change)
         self._refresh_config_file()
 
     def _refresh_config_file(self):
-        with io.open(self._config_file, 'w', encoding='utf-8') as f:
+        with self._token_lock, io.open(self._config_file, 'w', encoding='utf-8') as f:
             json_data = json.dumps({'access_token': self._access_token,
                                     'user_id': self._user_id,
                                     'expiration_date': self._expiration_date,
                                     'last_post_fetch_date': self.last_post_fetch_date}, ensure_ascii=False, indent=2)
             f.write(json_data)
-            print(f'JSON data saved to file: {json_data}')
+            print(f'Configuration saved to file: {self._config_file}')
 
     def set_fetch_date(self, fetch_date):
         self.last_post_fetch_date = fetch_date
         self._refresh_config_file()
 
     def get_user_details(self, fields=_ALL_USER_FIELDS):
-        response = requests.get(
-            f'{self._BASE_API_PATH}/{self._API_VERSION}/{self._user_id}?access_token={self._access_token}&fields={fields}')
+        response = self._get(
+            f'{self._BASE_API_PATH}/{self._API_VERSION}/{self._user_id}?access_token={self._access_token}&fields={fields}', 'user details')
         response_json = response.json()
 
         if response.status_code != 200:
-            print(f'Error while trying to make user details request {response.url}: {response_json}')
+            print(f'Error while trying to make user details request {self._redacted(response.url)}: {response_json}')
             exit(1)
 
         return InstagramUser(response_json)
 
-    def get_user_medias(self, since: int = None, until: int = None, fields=_ALL_MEDIA_FIELDS, with_children_data=False, exclude_media_ids=[]):
-        print(f'Fetching media from profile since: {datetime.fromtimestamp(since)}')
-        response = requests.get(
-            f'{self._BASE_API_PATH}/{self._API_VERSION}/{self._user_id}/media?access_token={self._access_token}&fields={fields}&since={since if since else ""}&until={until if until else ""}')
-        response_json = response.json()
-        response_data = []
-
-        if 'data' in response_json:
-            response_data = response_json['data']
-
-        while 'paging' in response_json and 'next' in response_json['paging']:
-            response = requests.get(response_json['paging']['next'])
+    def _iter_pages(self, url, request_name):
+        # Follows `paging.next` links lazily, yielding each page's items as soon as the page arrives.
+        while url:
+            response = self._get(url, request_name)
             response_json = response.json()
 
-            if 'data' in response_json:
-                response_data.extend(response_json['data'])
-
-        if response.status_code != 200:
-            print(f'Error while trying to make media request {response.url}: {response_json}')
-            exit(1)
-
-        # Remove filtered items.
-        for index, media in enumerate(response_data):
-            if media['id'] in exclude_media_ids or media['media_type'] == 'VIDEO':
-                del response_data[index]
-
-        if with_children_data:
-            for media in response_data:
-                # children are only available for "CAROUSEL_ALBUM" media types.
-                if ('media_type', 'CAROUSEL_ALBUM') in media.items():
-                    media['children'] = self.get_media_children(media['id'])
-
-        return [InstagramMedia(media_json) for media_json in response_data]
+            if response.status_code != 200:
+                print(f'Error while trying to make {request_name} request [{self._redacted(response.url)}]: {response_json}')
+                exit(1)
+
+            yield from response_json.get('data', [])
+            url = response_json.get('paging', {}).get('next')
+
+    def iter_user_medias(self, since: int = None, until: int = None, fields=_ALL_MEDIA_FIELDS, with_children_data=False, exclude_media_ids=[], expand_children=True):
+        print(f'Fetching media from profile since: {datetime.fromtimestamp(since if since else 0)}')
+        exclude_media_ids = set(exclude_media_ids)
+        if with_children_data and expand_children and 'children' not in fields:
+            # Nested field expansion returns carousel children inline with each media page (no N+1 requests).
+            fields = f'{fields},children{{{self._ALL_CHILDREN_MEDIA_FIELDS}}}'
+        url = f'{self._BASE_API_PATH}/{self._API_VERSION}/{self._user_id}/media?access_token={self._access_token}&fields={fields}&since={since if since else ""}&until={until if until else ""}'
+
+        for media in self._iter_pages(url, 'media'):
+            # Remove filtered items.
+            if media['id'] in exclude_media_ids or media.get('media_type') == 'VIDEO':
+                continue
+
+            # children are only available for "CAROUSEL_ALBUM" media types.
+            if with_children_data and media.get('media_type') == 'CAROUSEL_ALBUM':
+                media['children'] = self._carousel_children(media)
+            else:
+                media.pop('children', None)
+
+            yield InstagramMedia(media)
+
+    def get_user_medias(self, since: int = None, until: int = None, fields=_ALL_MEDIA_FIELDS, with_children_data=False, exclude_media_ids=[], expand_children=True):
+        return list(self.iter_user_medias(since, until, fields, with_children_data, exclude_media_ids, expand_children))
+
+    def _carousel_children(self, media):
+        expanded_children = media.get('children')
+        if not isinstance(expanded_children, dict):
+            # Not expanded inline, page through the children edge instead.
+            return self.get_media_children(media['id'])
+
+        children_data = list(expanded_children.get('data', []))
+        next_url = expanded_children.get('paging', {}).get('next')
+        if next_url:
+            # Inline children were truncated, only the remaining pages are requested.
+            children_data.extend(self._iter_pages(next_url, 'media children'))
+
+        return [child for child in children_data if self._is_supported_child(child)]
+
+    @staticmethod
+    def _is_supported_child(media):
+        if media.get('media_type') == 'VIDEO':
+            print(f'Video media type is not supported for children media: {media}')
+            return False
+        return True
+
+    def iter_media_children(self, media_id, fields=_ALL_CHILDREN_MEDIA_FIELDS):
+        url = f'{self._BASE_API_PATH}/{self._API_VERSION}/{media_id}/children?access_token={self._access_token}&fields={fields}'
+
+        for media in self._iter_pages(url, 'media children'):
+            if self._is_supported_child(media):
+                yield InstagramMedia(media)
 
     def get_media_children(self, media_id, fields=_ALL_CHILDREN_MEDIA_FIELDS):
-        response = requests.get(
-            f'{self._BASE_API_PATH}/{self._API_VERSION}/{media_id}/children?access_token={self._access_token}&fields={fields}')
-        response_json = response.json()
-        response_data = []
-
-        if 'data' in response_json:
-            response_data = response_json['data']
+        return list(self.iter_media_children(media_id, fields))
 
-        for index, media in enumerate(response_data):
-            if media['media_type'] == 'VIDEO':
-                print(f'Video media type is not supported for children media: {media}')
-                del response_data[index]
+    def download_media(self, media, destination_path):
+        file_path = None
+        # Closing the streamed response hands its connection back to the pool.
+        with self._get(media, 'media download', stream=True) as response:
+            if response.status_code == 200:
+                with open(f'{destination_path}', 'wb') as file:
+                    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                        file.write(chunk)
+                    file_path = file.name
+                print(f'Image downloaded to {destination_path}')
 
-        while 'paging' in response_json and 'next' in response_json['paging']:
-            response = requests.get(response_json['paging']['next'])
-            response_json = response.json()
-            response_data.extend(response_json['data'])
+        return file_path
 
+    def open_media_stream(self, media):
+        # Caller is responsible for closing the response (e.g. using it as a context manager).
+        response = self._get(media, 'media download', stream=True)
         if response.status_code != 200:
-            print(f'Error while trying to make media children request [{response.url}]: {response_json}')
+            response.close()
+            print(f'Error while trying to stream media [{response.url}]: {response.status_code}')
             exit(1)
 
-        return [InstagramMedia(media_json) for media_json in response_data]
-    
-    def download_media(self, media, destination_path):
-        file_path = None
-        response = requests.get(media, stream=True)
-        if response.status_code == 200:
-            with open(f'{destination_path}', 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-                file_path = file.name
-            print(f'Image downloaded to {destination_path}')
-
-        return file_path
+        return response
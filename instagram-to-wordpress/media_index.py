@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import hashlib
+import sqlite3
+import threading
+from http_session import STREAM_CHUNK_SIZE
+
+
+class MediaIndex():
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+
+    def __init__(self, index_file='media_index.db'):
+        # Shared by the pipeline workers, so one connection is used under a lock.
+        self._connection = sqlite3.connect(index_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS media (
+                                            wordpress_media_id INTEGER NOT NULL,
+                                            instagram_media_id TEXT UNIQUE,
+                                            content_hash TEXT)''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS media_content_hash ON media (content_hash)')
+
+    @staticmethod
+    def new_hasher():
+        return hashlib.sha256()
+
+    @staticmethod
+    def file_hash(file_path):
+        hasher = MediaIndex.new_hasher()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(STREAM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def find(self, instagram_media_id=None, content_hash=None):
+        with self._lock:
+            row = None
+            if instagram_media_id:
+                row = self._connection.execute('SELECT wordpress_media_id FROM media WHERE instagram_media_id = ?',
+                                               (instagram_media_id,)).fetchone()
+            if row is None and content_hash:
+                row = self._connection.execute('SELECT wordpress_media_id FROM media WHERE content_hash = ? LIMIT 1',
+                                               (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, wordpress_media_id, instagram_media_id=None, content_hash=None):
+        with self._lock, self._connection:
+            if instagram_media_id:
+                self._connection.execute('DELETE FROM media WHERE instagram_media_id = ?', (instagram_media_id,))
+            self._connection.execute('INSERT INTO media (wordpress_media_id, instagram_media_id, content_hash) VALUES (?, ?, ?)',
+                                     (wordpress_media_id, instagram_media_id, content_hash))
+
+    def rebuild(self, wordpress_client, session):
+        # Hashes every file of the site's media library so content already on WordPress is never uploaded again.
+        indexed = 0
+        for media_json in wordpress_client.iter_media():
+            hasher = self.new_hasher()
+            with session.get(media_json['source_url'], stream=True) as response:
+                if response.status_code != 200:
+                    print(f'Skipping media {media_json["id"]}, could not download [{response.url}]: {response.status_code}')
+                    continue
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    hasher.update(chunk)
+
+            content_hash = hasher.hexdigest()
+            if self.find(content_hash=content_hash) is None:
+                self.add(media_json['id'], content_hash=content_hash)
+                indexed += 1
+
+        print(f'Media index rebuilt, {indexed} WordPress media indexed.')
+        return indexed
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from image_transcoder import ImageTranscoder, transcode_image
+from instagram_client import InstagramClient, InstagramMedia
+from media_index import MediaIndex
+from sync_ledger import SyncLedger
+from wordpress_client import WordpressClient
+
+DOWNLOAD_DIR = './test'
+
+
+def post_details(media: InstagramMedia):
+    title = media.posted_at.strftime('%d/%m/%Y %H:%M')  # title for now is the formatted timestamp.
+    return title, media.caption, list(media.hashtags), media.posted_at  # all hashtags are treated as categories and tags.
+
+
+def post_images(media: InstagramMedia):
+    if len(media.children) > 0:
+        return list(media.children)
+    return [media]
+
+
+def media_filename(media_url):
+    return media_url.split('/')[-1].split('?')[0]
+
+
+def local_media_path(media_url, download_dir=DOWNLOAD_DIR):
+    return os.path.join(download_dir, media_filename(media_url))
+
+
+def iter_prefetched(iterable, buffer_size=50):
+    # Drains `iterable` (e.g. Instagram paging) on a background thread so later pages are fetched
+    # while earlier posts are being migrated. The bounded queue keeps memory flat.
+    buffer = queue.Queue(maxsize=buffer_size)
+    end_of_items = object()
+    errors = []
+    # Set once the consumer is gone (done, failed or closed early), so the producer stops instead of blocking on a full buffer.
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as err:  # includes SystemExit raised by the clients' exit(1).
+            errors.append(err)
+        finally:
+            put(end_of_items)
+
+    threading.Thread(target=produce, name='instagram-prefetch', daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is end_of_items:
+                break
+            yield item
+    finally:
+        stop.set()
+    if errors:
+        raise errors[0]
+
+
+def ledger_resume_point(ledger: SyncLedger, media: InstagramMedia):
+    # Returns (skip, uploaded media ids) according to what previous runs already did for this media.
+    if ledger is None:
+        return False, None
+    entry = ledger.get(media.id)
+    if entry is None or entry.status == SyncLedger.FETCHED:
+        ledger.record_fetched(media.id)
+        return False, None
+    if entry.status == SyncLedger.POST_CREATED:
+        print(f'Skipping Instagram media {media.id}, already posted as WordPress post {entry.wordpress_post_id}')
+        return True, None
+    return False, entry.wordpress_media_ids
+
+
+def _then_submit(future: Future, executor: ThreadPoolExecutor, fn, *args):
+    # Chains `fn(future.result(), *args)` onto another pool without blocking a worker while waiting.
+    chained = Future()
+
+    def copy_result(done: Future):
+        if done.cancelled():
+            chained.cancel()
+        elif done.exception() is not None:
+            chained.set_exception(done.exception())
+        else:
+            chained.set_result(done.result())
+
+    def on_done(done: Future):
+        if done.cancelled():
+            chained.cancel()
+            return
+        if done.exception() is not None:
+            chained.set_exception(done.exception())
+            return
+        try:
+            executor.submit(fn, done.result(), *args).add_done_callback(copy_result)
+        except RuntimeError as err:  # executor already shut down.
+            chained.set_exception(err)
+
+    future.add_done_callback(on_done)
+    return chained
+
+
+def _completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class MediaMigrator():
+    _instagram_client: InstagramClient
+    _wordpress_client: WordpressClient
+    _download_dir: str
+    _stream: bool
+    _media_index: MediaIndex
+    _ledger: SyncLedger
+    _transcoder: ImageTranscoder
+
+    def __init__(self, instagram_client: InstagramClient, wordpress_client: WordpressClient, download_dir=DOWNLOAD_DIR, stream=False,
+                 media_index: MediaIndex = None, ledger: SyncLedger = None, transcoder: ImageTranscoder = None):
+        self._instagram_client = instagram_client
+        self._wordpress_client = wordpress_client
+        self._download_dir = download_dir
+        self._stream = stream
+        self._media_index = media_index
+        self._ledger = ledger
+        self._transcoder = transcoder  # only applies to downloaded media, streamed media never touch the disk.
+
+    def _known_media_id(self, image: InstagramMedia):
+        if self._ledger is not None:
+            # Uploaded by an earlier run that stopped before the post was created (e.g. another image of the carousel failed).
+            media_id = self._ledger.uploaded_image(image.id)
+            if media_id is not None:
+                print(f'Reusing WordPress media {media_id} already uploaded for Instagram media {image.id}')
+                return media_id
+        if self._media_index is None:
+            return None
+        media_id = self._media_index.find(instagram_media_id=image.id)
+        if media_id is not None:
+            print(f'Reusing WordPress media {media_id} for Instagram media {image.id}')
+        return media_id
+
+    def _record_uploaded(self, image: InstagramMedia, media_id, content_hash=None):
+        if self._ledger is not None:
+            self._ledger.record_image_uploaded(image.id, media_id)
+        if self._media_index is not None:
+            self._media_index.add(media_id, image.id, content_hash)
+
+    def _download_image(self, image: InstagramMedia):
+        return self._instagram_client.download_media(image.media_url, local_media_path(image.media_url, self._download_dir))
+
+    def _upload_downloaded_image(self, media_path, image: InstagramMedia, title):
+        try:
+            content_hash = None
+            if self._media_index is not None:
+                # Same bytes already uploaded (e.g. reposted image), so only the mapping is recorded.
+                content_hash = MediaIndex.file_hash(media_path)
+                media_id = self._media_index.find(content_hash=content_hash)
+                if media_id is not None:
+                    print(f'Reusing WordPress media {media_id} with the same content as {media_path}')
+                    self._record_uploaded(image, media_id, content_hash)
+                    return media_id
+
+            media_data = self._wordpress_client.upload_post_media(media_path, f'{title}', f'{title}', f'Media uploaded for post titled: {title}')
+            self._record_uploaded(image, media_data['id'], content_hash)
+            return media_data['id']
+        finally:
+            os.remove(media_path)
+
+    def _transfer_image(self, image: InstagramMedia, title):
+        # Pipes the Instagram CDN response straight into the WordPress upload, no temporary file involved.
+        media_id = self._known_media_id(image)
+        if media_id is not None:
+            return media_id
+
+        hashers = []
+
+        def open_stream():
+            # A fresh hasher per attempt, as a retried upload re-reads the stream from the start.
+            hashers.append(MediaIndex.new_hasher())
+            return self._instagram_client.open_media_stream(image.media_url)
+
+        media_data = self._wordpress_client.upload_post_media_stream(open_stream, media_filename(image.media_url),
+                                                                     f'{title}', f'{title}', f'Media uploaded for post titled: {title}',
+                                                                     on_chunk=lambda chunk: hashers[-1].update(chunk))
+        self._record_uploaded(image, media_data['id'], hashers[-1].hexdigest())
+        return media_data['id']
+
+    def _upload_image(self, image: InstagramMedia, title):
+        if self._stream:
+            return self._transfer_image(image, title)
+
+        media_id = self._known_media_id(image)
+        if media_id is not None:
+            return media_id
+        media_path = self._download_image(image)
+        if self._transcoder is not None:
+            media_path = self._transcoder.transcode(media_path)
+        return self._upload_downloaded_image(media_path, image, title)
+
+    def _create_posts(self, medias_with_ids):
+        # [(media, uploaded media ids)] become WordPress posts in that order, batched when there are several.
+        if self._ledger is not None:
+            for media, media_ids in medias_with_ids:
+                self._ledger.record_media_uploaded(media.id, media_ids)
+
+        # Use hashtags as both tags and categories, date as the post date.
+        posts = []
+        for media, media_ids in medias_with_ids:
+            title, content, hashtags, timestamp = post_details(media)
+            posts.append({'title': title, 'content': content, 'categories': hashtags, 'tags': hashtags, 'date': timestamp, 'media_ids': media_ids})
+        posts_json = self._wordpress_client.create_posts(posts)
+
+        # Posts of a batch that were created are recorded even when another one failed, so a resumed run doesn't duplicate them.
+        if self._ledger is not None:
+            for (media, _), post_json in zip(medias_with_ids, posts_json):
+                if post_json is not None:
+                    self._ledger.record_post_created(media.id, post_json['id'])
+        if any(post_json is None for post_json in posts_json):
+            exit(1)
+
+    def _create_post(self, media: InstagramMedia, media_ids):
+        self._create_posts([(media, media_ids)])
+
+    def migrate_media(self, media: InstagramMedia):
+        skip, media_ids = ledger_resume_point(self._ledger, media)
+        if skip:
+            return
+
+        if media_ids is None:
+            title = post_details(media)[0]
+            media_ids = [self._upload_image(image, title) for image in post_images(media)]
+        self._create_post(media, media_ids)
+
+    def migrate_medias(self, medias):
+        if not self._stream:
+            os.makedirs(self._download_dir, exist_ok=True)
+        for media in medias:
+            self.migrate_media(media)
+
+    def _submit_image(self, image: InstagramMedia, title, download_pool: ThreadPoolExecutor, upload_pool: ThreadPoolExecutor):
+        if self._stream:
+            return upload_pool.submit(self._transfer_image, image, title)
+
+        media_id = self._known_media_id(image)
+        if media_id is not None:
+            return _completed(media_id)
+
+        download_future = download_pool.submit(self._download_image, image)
+        if self._transcoder is not None:
+            # Recompressed on the process pool between download and upload, without holding any thread.
+            download_future = _then_submit(download_future, self._transcoder.pool, transcode_image, self._transcoder.options)
+        return _then_submit(download_future, upload_pool, self._upload_downloaded_image, image, title)
+
+    def migrate_medias_pipelined(self, medias, workers=4, max_in_flight=8, download_pool=None, upload_pool=None):
+        # Downloads and uploads run ahead on their own pools while posts are created one by one,
+        # in the same order as `medias`, so WordPress post chronology matches the sequential mode.
+        # With stream, each upload worker pipes its download directly and the download pool stays idle.
+        # Pools can be passed in (e.g. AccountExecutor shares of a multi-account pool); either way they're shut down at the end.
+        if not self._stream:
+            os.makedirs(self._download_dir, exist_ok=True)
+        if download_pool is None:
+            download_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='instagram-download')
+        if upload_pool is None:
+            upload_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wordpress-upload')
+        in_flight = deque()
+
+        def create_oldest_posts():
+            # Waits for the oldest post's media; the posts right behind it that are ready too go in the same batch.
+            media, upload_futures = in_flight.popleft()
+            ready = [(media, [upload_future.result() for upload_future in upload_futures])]
+            while in_flight and len(ready) < WordpressClient.MAX_BATCH_SIZE and all(upload_future.done() for upload_future in in_flight[0][1]):
+                media, upload_futures = in_flight.popleft()
+                ready.append((media, [upload_future.result() for upload_future in upload_futures]))
+            self._create_posts(ready)
+
+        try:
+            for media in iter_prefetched(medias, max_in_flight):
+                skip, media_ids = ledger_resume_point(self._ledger, media)
+                if skip:
+                    continue
+
+                if media_ids is not None:
+                    upload_futures = [_completed(media_id) for media_id in media_ids]
+                else:
+                    title = post_details(media)[0]
+                    upload_futures = [self._submit_image(image, title, download_pool, upload_pool) for image in post_images(media)]
+                in_flight.append((media, upload_futures))
+
+                if len(in_flight) >= max_in_flight:
+                    create_oldest_posts()
+
+            while in_flight:
+                create_oldest_posts()
+        finally:
+            download_pool.shutdown(wait=True, cancel_futures=True)
+            upload_pool.shutdown(wait=True, cancel_futures=True)
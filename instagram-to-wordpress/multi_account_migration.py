@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+from account_executor import AccountExecutor
+from http_session import PooledSession, session_from_env
+from instagram_client import InstagramClient
+from migration_pipeline import DOWNLOAD_DIR, MediaMigrator
+from request_metrics import RequestMetrics, write_metrics
+from request_scheduler import scheduler_from_env
+from sync_ledger import SyncLedger
+from taxonomy_cache import TermCache
+from token_store import TokenStore
+from wordpress_client import WordpressClient
+
+# Manifest keys falling back to the environment variables used by instagram-to-wordpress.py.
+WORDPRESS_ENV_KEYS = {'wordpress_client_id': 'WORDPRESS_CLIENT_ID', 'wordpress_client_secret': 'WORDPRESS_CLIENT_SECRET',
+                      'wordpress_username': 'WORDPRESS_USERNAME', 'wordpress_application_password': 'WORDPRESS_APPLICATION_PASSWORD'}
+
+
+def load_manifest(manifest_file):
+    # {"accounts": [{"name", "instagram_config", "wordpress_site", optional credentials/files/max_workers}, ...]}
+    with open(manifest_file) as f:
+        accounts = json.load(f).get('accounts', [])
+
+    required_keys = ['name', 'instagram_config', 'wordpress_site']
+    for account in accounts:
+        if any(key not in account for key in required_keys):
+            print(f'Missing one or more required keys ({required_keys}) from manifest account: {account.get("name", account)}')
+            exit(1)
+        for key, env_key in WORDPRESS_ENV_KEYS.items():
+            account.setdefault(key, os.environ.get(env_key))
+            if account[key] is None:
+                print(f'Missing {key} for account {account["name"]}, set it in the manifest or through {env_key}')
+                exit(1)
+
+    if len({account['name'] for account in accounts}) != len(accounts):
+        print('Account names must be unique in the manifest, they name every per-account file')
+        exit(1)
+    return accounts
+
+
+class SharedResources():
+    # What accounts share: one keep-alive session (a connection pool per host), one worker pool, and one rate limiter
+    # per API app, as quotas are per Instagram app and per WordPress client id rather than per account.
+    session: PooledSession
+    pool: ThreadPoolExecutor
+    _schedulers: dict
+    _lock: threading.Lock
+
+    def __init__(self, workers):
+        self.session = session_from_env(workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shared-transfer')
+        self._schedulers = {}
+        self._lock = threading.Lock()
+
+    def scheduler(self, api, app):
+        with self._lock:
+            if (api, app) not in self._schedulers:
+                self._schedulers[(api, app)] = scheduler_from_env()
+            return self._schedulers[(api, app)]
+
+
+def migrate_account(account, shared: SharedResources, args, all_metrics):
+    name = account['name']
+    instagram_metrics = RequestMetrics(f'instagram/{name}')
+    wordpress_metrics = RequestMetrics(f'wordpress/{name}')
+    all_metrics.extend([instagram_metrics, wordpress_metrics])
+
+    instagram_client = InstagramClient(account['instagram_config'], session=shared.session,
+                                       scheduler=shared.scheduler('instagram', account.get('instagram_app', 'default')),
+                                       base_api_path=os.environ.get('INSTAGRAM_API_BASE_URL'), metrics=instagram_metrics)
+    term_cache = TermCache(account.get('term_cache'))
+    wordpress_client = WordpressClient(account['wordpress_client_id'], account['wordpress_client_secret'], account['wordpress_username'],
+                                       account['wordpress_application_password'], account['wordpress_site'], session=shared.session,
+                                       term_cache=term_cache, scheduler=shared.scheduler('wordpress', account['wordpress_client_id']),
+                                       token_store=TokenStore(account.get('wordpress_token_cache', f'{name}_wordpress_token.json')),
+                                       base_api_path=os.environ.get('WORDPRESS_API_BASE_URL'),
+                                       oauth_token_url=os.environ.get('WORDPRESS_OAUTH_TOKEN_URL'),
+                                       batch_url=account.get('wordpress_batch_url', os.environ.get('WORDPRESS_BATCH_URL')), metrics=wordpress_metrics)
+    if term_cache.is_empty():
+        wordpress_client.warm_term_cache()
+
+    cycle_started_at = int(datetime.now().timestamp())
+    ledger = SyncLedger(account.get('ledger', f'{name}_sync_ledger.db'))
+    instagram_posts = instagram_client.iter_user_medias(with_children_data=True, since=int(instagram_client.last_post_fetch_date),
+                                                        exclude_media_ids=ledger.completed_media_ids())
+
+    # Downloads and uploads of this account go to its share of the pool; its posts are still created in order.
+    account_pool = AccountExecutor(shared.pool, account.get('max_workers', args.account_workers))
+    migrator = MediaMigrator(instagram_client, wordpress_client, download_dir=os.path.join(args.download_dir, name), stream=args.stream,
+                             ledger=ledger)
+    migrator.migrate_medias_pipelined(instagram_posts, max_in_flight=args.max_in_flight, download_pool=account_pool, upload_pool=account_pool)
+
+    instagram_client.set_fetch_date(cycle_started_at)
+    ledger.close()
+    print(f'Account {name} migrated')
+
+
+def run_accounts(accounts, args):
+    shared = SharedResources(args.workers)
+    all_metrics = []
+    failed = []
+
+    def run(account):
+        try:
+            migrate_account(account, shared, args, all_metrics)
+        except (SystemExit, OSError) as err:  # one failing account doesn't stop the others (requests' errors are OSErrors too).
+            print(f'Account {account["name"]} failed: {err}')
+            failed.append(account['name'])
+
+    # Each account's driver (paging, post creation) has its own thread, only transfers use the shared pool.
+    with ThreadPoolExecutor(max_workers=args.max_accounts if args.max_accounts else len(accounts), thread_name_prefix='account') as drivers:
+        list(drivers.map(run, accounts))
+    shared.pool.shutdown(wait=True)
+
+    write_metrics(args.metrics_json, args.metrics_prometheus, *all_metrics)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replicate the posts of several Instagram accounts into their WordPress sites, '
+                                                 'listed in a JSON manifest, sharing workers, connections and rate limits.')
+    parser.add_argument('manifest', help='JSON file listing the account/site pairs, see README.')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Worker threads shared by every account for downloads/uploads.')
+    parser.add_argument('--account-workers', type=int, default=4,
+                        help="Maximum shared workers a single account uses at once, unless its manifest entry sets max_workers.")
+    parser.add_argument('--max-accounts', type=int, default=None,
+                        help='Accounts migrated at the same time (all of them by default).')
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                        help='Maximum number of posts per account downloading/uploading ahead of post creation.')
+    parser.add_argument('--download-dir', default=DOWNLOAD_DIR,
+                        help='Directory for temporary downloads, with a sub-directory per account.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Pipe Instagram media straight into the WordPress upload instead of going through temporary files.')
+    parser.add_argument('--metrics-json', default=None,
+                        help='File where per account and endpoint request metrics are saved as JSON at the end of the run.')
+    parser.add_argument('--metrics-prometheus', default=None,
+                        help='File where per account and endpoint request metrics are saved in Prometheus text format.')
+    args = parser.parse_args()
+
+    load_dotenv()
+    failed = run_accounts(load_manifest(args.manifest), args)
+    if failed:
+        print(f'Accounts that failed: {failed}')
+        exit(1)
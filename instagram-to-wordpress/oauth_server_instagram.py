@@ -1,88 +1,154 @@
 #!/usr/bin/python3
 
+import argparse
 import io
 import json
 import http.server
 import os
-import socketserver
 import ssl
 import threading
-import time
 import webbrowser
-import requests
+from concurrent.futures import Future, InvalidStateError, TimeoutError
 from datetime import datetime, timedelta
-from typing import Tuple
 from http import HTTPStatus
-from urllib.parse import urlsplit, parse_qs
+from urllib.parse import urlencode, urlsplit, parse_qs
 from dotenv import load_dotenv
+from http_session import PooledSession
 
+AUTHORIZE_URL = 'https://api.instagram.com/oauth/authorize'
+SHORT_LIVED_TOKEN_URL = 'https://api.instagram.com/oauth/access_token'
+LONG_LIVED_TOKEN_URL = 'https://graph.instagram.com/access_token'
 
-class SimpleHttpServer(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, request: bytes, client_address: Tuple[str, int], server: socketserver.BaseServer):
-        super().__init__(request, client_address, server)
 
-    @property
-    def api_response(self):
-        return json.dumps({"message": "OAuth Authorization code was successfully retrieved." if OAuthServer.authorization_code != "" else "Missing OAuth Authorization code from request!"}).encode()
+class OAuthCallbackHandler(http.server.BaseHTTPRequestHandler):
+    server: 'OAuthHttpServer'
 
     def do_GET(self):
         url = urlsplit(self.path)
-        if url.path == '/':
-            query_string = parse_qs(url.query)
-            if 'code' in query_string:
-                OAuthServer.authorization_code = query_string['code'][0]
-        self.send_response(
-            HTTPStatus.OK if OAuthServer.authorization_code != "" else HTTPStatus.BAD_REQUEST)
-        self.send_header("Content-Type", "application/json")
+        query_string = parse_qs(url.query) if url.path == '/' else {}
+        if 'code' in query_string:
+            status, message = HTTPStatus.OK, 'OAuth Authorization code was successfully retrieved.'
+            self.server.resolve(code=query_string['code'][0])
+        elif 'error' in query_string:
+            # e.g. the user denied the permissions, no code will ever come.
+            status, message = HTTPStatus.BAD_REQUEST, f'OAuth Authorization failed: {query_string.get("error_description", query_string["error"])[0]}'
+            self.server.resolve(error=message)
+        else:
+            status, message = HTTPStatus.BAD_REQUEST, 'Missing OAuth Authorization code from request!'
+
+        api_response = json.dumps({'message': message}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(api_response)))
         self.end_headers()
-        self.wfile.write(bytes(self.api_response))
+        self.wfile.write(api_response)
+
+    def log_message(self, format, *args):
+        pass  # the callback query string holds the authorization code.
+
+
+class OAuthHttpServer(http.server.ThreadingHTTPServer):
+    # The authorization code is handed to the waiting thread through a future, set the moment the redirect lands.
+    allow_reuse_address = True
+    daemon_threads = True
+    authorization_code: Future
+
+    def __init__(self, server_address, ssl_context: ssl.SSLContext):
+        super().__init__(server_address, OAuthCallbackHandler)
+        # The TLS handshake happens on the request's own thread, so a stalled client doesn't block accepting the others.
+        self.socket = ssl_context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.authorization_code = Future()
+
+    def resolve(self, code=None, error=None):
+        try:
+            if error is not None:
+                self.authorization_code.set_exception(RuntimeError(error))
+            else:
+                self.authorization_code.set_result(code)
+        except InvalidStateError:
+            pass  # only the first callback counts, e.g. a browser retrying the redirect doesn't change the code.
+
+    def handle_error(self, request, client_address):
+        pass  # e.g. TLS handshakes of browsers rejecting the self-signed certificate, the next request is still served.
 
 
 class OAuthServer:
-    authorization_code = ""
     PORT = 8000
-    _my_server: SimpleHttpServer
-    _server_started = False
+    _port: int
+    _ssl_context: ssl.SSLContext
+    _my_server: OAuthHttpServer
+    _server_thread: threading.Thread
+
+    def __init__(self, port=PORT, cert_file='./cert.pem', key_file='./key.pem'):
+        if not 'SSL_PASSWORD' in os.environ:
+            print(f"Missing SSL_PASSWORD set as environment variable.")
+            exit(1)
+
+        # Loaded upfront, so a wrong certificate or password fails before the user goes through the login.
+        self._port = port
+        self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        try:
+            self._ssl_context.load_cert_chain(cert_file, key_file, password=os.environ['SSL_PASSWORD'])
+        except (ssl.SSLError, OSError) as err:
+            print(f"Could not load the SSL certificate {cert_file} and key {key_file}: {err}")
+            exit(1)
+        self._my_server = None
 
     def start_oauth_server(self):
-        # Start the server
-        self.authorization_code = ""
-        # tries 5 times to start server before identifying as an error.
-        tries = 0
-        while not self._server_started and tries < 5:
-            try:
-                if not 'SSL_PASSWORD' in os.environ:
-                    print(f"Missing SSL_PASSWORD set as environment variable.")
-                    exit(1)
-
-                socketserver.TCPServer.allow_reuse_address = True
-                self._my_server = socketserver.TCPServer(
-                    ("0.0.0.0", self.PORT), SimpleHttpServer)
-                ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-                ssl_context.load_cert_chain(
-                    "./cert.pem", "./key.pem", password=os.environ['SSL_PASSWORD'])
-                self._my_server.socket = ssl_context.wrap_socket(
-                    self._my_server.socket, server_side=True)
-                print(f"Server started at {self.PORT}")
-                self._server_started = True
-                self._my_server.serve_forever()
-            except Exception as err:
-                tries += 1
-                self._server_started = False
-                if tries == 5:
-                    print(f"Exception happened while starting server: {err}")
-                    exit(1)
-                else:
-                    time.sleep(2)  # waits 2 seconds before next try
+        try:
+            self._my_server = OAuthHttpServer(('0.0.0.0', self._port), self._ssl_context)
+        except OSError as err:
+            print(f"Exception happened while starting server: {err}")
+            exit(1)
+        self._server_thread = threading.Thread(target=self._my_server.serve_forever, name='oauth-server', daemon=True)
+        self._server_thread.start()
+        print(f"Server started at {self._port}")
+
+    def wait_for_authorization_code(self, timeout=None):
+        return self._my_server.authorization_code.result(timeout)
 
     def stop_oauth_server(self):
-        if self._server_started:
-            print(f"Server shutdown requested on port {self.PORT}")
+        if self._my_server is not None:
+            print(f"Server shutdown requested on port {self._port}")
             self._my_server.shutdown()
+            self._my_server.server_close()
+            self._my_server = None
+
+
+def retrieve_long_lived_token(session: PooledSession, app_id, app_secret, redirect_url, authorization_code):
+    # Both exchanges go through the same keep-alive session, right after the code arrives (it is only valid for a short time).
+    short_lived_response = session.post(SHORT_LIVED_TOKEN_URL, data={'client_id': app_id, 'client_secret': app_secret, 'grant_type': 'authorization_code',
+                                                                     'redirect_uri': redirect_url, 'code': authorization_code})
+    short_lived_json = short_lived_response.json()
+    if not 'access_token' in short_lived_json or not 'user_id' in short_lived_json:
+        print(f"Missing access_token or user_id from response of short lived request: {short_lived_json}")
+        exit(1)
+    print(f"Short lived token retrieved for user {short_lived_json['user_id']}")
+
+    long_lived_response = session.get(LONG_LIVED_TOKEN_URL, params={'grant_type': 'ig_exchange_token', 'client_secret': app_secret,
+                                                                    'access_token': short_lived_json['access_token']})
+    long_lived_json = long_lived_response.json()
+    if not 'access_token' in long_lived_json or not 'expires_in' in long_lived_json:
+        print(f"Missing access_token or expires_in from response of long lived request: {long_lived_json}")
+        exit(1)
+    print(f"Long lived token retrieved, expires in {timedelta(seconds=long_lived_json['expires_in'])}")
+    return short_lived_json['user_id'], long_lived_json
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Retrieve a long lived Instagram access token through the OAuth login, '
+                                                 'and save it for InstagramClient.')
+    parser.add_argument('--config-file', default='instagram_config.json',
+                        help='File the token is saved to, one per account when onboarding several accounts.')
+    parser.add_argument('--port', type=int, default=OAuthServer.PORT,
+                        help='Port of the local HTTPS server receiving the OAuth redirect (must match the redirect URI of the app).')
+    parser.add_argument('--no-browser', action='store_true',
+                        help='Print the authorization URL instead of opening it in a browser.')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Seconds to wait for the OAuth redirect before giving up (waits forever by default).')
+    args = parser.parse_args()
+
     load_dotenv()
     if not 'INSTAGRAM_APP_SECRET' in os.environ:
         print(f"Missing INSTAGRAM_APP_SECRET set as environment variable.")
@@ -95,55 +161,42 @@ if __name__ == "__main__":
     # Getting all needed parameters.
     app_secret = os.environ['INSTAGRAM_APP_SECRET']
     app_id = os.environ['INSTAGRAM_APP_ID']  # Configured app_id on instagram API.
-    redirect_url = f"https://localhost:{OAuthServer.PORT}/"
+    redirect_url = f"https://localhost:{args.port}/"
 
-    # 1. Initial request needs to be opened in the browser so user accepts giving Instagram permissions.
-    webbrowser.open(
-        f'https://api.instagram.com/oauth/authorize?client_id={app_id}&redirect_uri={redirect_url}&scope=user_profile,user_media&response_type=code', new=2)
-
-    # 2. Logic so OAuth authorization code is retrieved by temporary server created for this purpose.
-    oauth_server = OAuthServer()
-    server_thread = threading.Thread(target=oauth_server.start_oauth_server)
+    # 1. Temporary server receiving the OAuth authorization code, started before the login so the redirect can't be missed.
+    oauth_server = OAuthServer(args.port)
+    oauth_server.start_oauth_server()
     try:
-        server_thread.start()
-        while OAuthServer.authorization_code == "":
-            # It was stopped due to an error on the OAuthServer thread.
-            if not server_thread.is_alive():
-                print("Error happened while executing thread.")
-                exit(1)
-            else:
-                time.sleep(5)
-
-        print(f"Authorization Code retrieved is: {OAuthServer.authorization_code}")
+        # 2. Initial request needs to be opened in the browser so user accepts giving Instagram permissions.
+        authorize_url = f"{AUTHORIZE_URL}?{urlencode({'client_id': app_id, 'redirect_uri': redirect_url, 'scope': 'user_profile,user_media', 'response_type': 'code'})}"
+        if args.no_browser:
+            print(f"Open this URL to log in: {authorize_url}")
+        else:
+            webbrowser.open(authorize_url, new=2)
+
+        try:
+            authorization_code = oauth_server.wait_for_authorization_code(args.timeout)
+        except TimeoutError:
+            print(f"No OAuth redirect received after {args.timeout} seconds.")
+            exit(1)
+        except RuntimeError as err:
+            print(err)
+            exit(1)
+        print("Authorization Code retrieved")
+
+        # 3. Short lived then long-lived access-token, right away.
+        user_id, long_lived_json = retrieve_long_lived_token(PooledSession(), app_id, app_secret, redirect_url, authorization_code)
     except KeyboardInterrupt:
         print("Execution of script interrupted by user")
+        exit(1)
     finally:
         oauth_server.stop_oauth_server()
-        server_thread.join()
-
-    # 3. Call to retrieve short lived access-token
-    short_lived_response = requests.post("https://api.instagram.com/oauth/access_token",
-                                         data={'client_id': app_id, 'client_secret': app_secret, 'grant_type': 'authorization_code', 'redirect_uri': redirect_url, 'code': OAuthServer.authorization_code})
-    short_lived_json = short_lived_response.json()
-    if not 'access_token' in short_lived_json or not 'user_id' in short_lived_json:
-        print(f"Missing access_token or user_id from response of short lived request: {short_lived_json}")
-        exit(1)
-    print(f"Short Lived Token: {short_lived_json}")
-
-    # 4. Call to retrieve long-lived access-token.
-    long_lived_response = requests.get(
-        f"https://graph.instagram.com/access_token?grant_type=ig_exchange_token&client_secret={app_secret}&access_token={short_lived_json['access_token']}")
-    long_lived_json = long_lived_response.json()
-    if not 'access_token' in long_lived_json or not 'expires_in' in long_lived_json:
-        print(f"Missing access_token or expires_in from response of long lived request: {long_lived_json}")
-        exit(1)
-    print(f"Long Lived Token: {long_lived_json}")
 
     # Saving the long-lived token into a file.
     time_change = timedelta(seconds=long_lived_json['expires_in'])
-    with io.open('instagram_config.json', 'w', encoding='utf-8') as f:
+    with io.open(args.config_file, 'w', encoding='utf-8') as f:
         json_data = json.dumps({'access_token': long_lived_json['access_token'],
-                                'user_id': short_lived_json['user_id'],
+                                'user_id': user_id,
                                 'expiration_date': datetime.timestamp(datetime.now() + time_change)}, ensure_ascii=False, indent=2)
         f.write(json_data)
-        print(f"JSON data saved to file: {json_data}")
+        print(f"Configuration saved to file: {args.config_file}")
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+import json
+import threading
+from collections import Counter
+
+
+class EndpointMetrics():
+    # Latency histogram upper bounds in seconds (the Prometheus client defaults, plus 30 and 60 for large uploads).
+    LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = Counter()
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)  # last one is +Inf.
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def observe(self, status, latency, bytes_out, bytes_in):
+        self.requests += 1
+        self.statuses[status] += 1
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        bucket = next((index for index, bound in enumerate(self.LATENCY_BUCKETS) if latency <= bound), len(self.LATENCY_BUCKETS))
+        self.latency_counts[bucket] += 1
+
+    def cumulative_latency_counts(self):
+        counts = []
+        total = 0
+        for count in self.latency_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def to_dict(self):
+        bounds = [str(bound) for bound in self.LATENCY_BUCKETS] + ['+Inf']
+        return {'requests': self.requests, 'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+                'retries': self.retries, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'latency_seconds': {'sum': round(self.latency_sum, 6), 'mean': round(self.latency_sum / self.requests, 6) if self.requests else None,
+                                    'max': round(self.latency_max, 6), 'buckets': dict(zip(bounds, self.cumulative_latency_counts()))}}
+
+
+class RequestMetrics():
+    # Per endpoint request telemetry of one API client, recorded by the RequestScheduler for every attempt.
+    client: str
+    _endpoints: dict
+
+    def __init__(self, client):
+        self.client = client
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = EndpointMetrics()
+        return self._endpoints[endpoint]
+
+    def record(self, endpoint, status, latency, bytes_out=0, bytes_in=0):
+        with self._lock:
+            self._endpoint(endpoint).observe(status, latency, bytes_out, bytes_in)
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self._endpoint(endpoint).retries += 1
+
+    def endpoints(self):
+        with self._lock:
+            return dict(self._endpoints)
+
+    def summary(self):
+        endpoints = {endpoint: metrics.to_dict() for endpoint, metrics in sorted(self.endpoints().items())}
+        return {'requests': sum(metrics['requests'] for metrics in endpoints.values()),
+                'retries': sum(metrics['retries'] for metrics in endpoints.values()),
+                'latency_seconds': round(sum(metrics['latency_seconds']['sum'] for metrics in endpoints.values()), 6),
+                'endpoints': endpoints}
+
+
+def json_summary(*all_metrics: RequestMetrics):
+    return {metrics.client: metrics.summary() for metrics in all_metrics}
+
+
+def _labels(**labels):
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in labels.items()}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+
+def prometheus_text(*all_metrics: RequestMetrics):
+    # Prometheus text exposition format, every metric family listed once for all clients.
+    families = {'api_requests_total': ('counter', 'API requests sent, by response status.', []),
+                'api_retries_total': ('counter', 'API requests sent again after a 401, 429 or 5xx response.', []),
+                'api_sent_bytes_total': ('counter', 'Request body bytes sent.', []),
+                'api_received_bytes_total': ('counter', 'Response body bytes received.', []),
+                'api_request_duration_seconds': ('histogram', 'API request latency until the response was received.', [])}
+    for metrics in all_metrics:
+        for endpoint, endpoint_metrics in sorted(metrics.endpoints().items()):
+            labels = {'client': metrics.client, 'endpoint': endpoint}
+            for status, count in sorted(endpoint_metrics.statuses.items()):
+                families['api_requests_total'][2].append(f'api_requests_total{_labels(**labels, status=status)} {count}')
+            families['api_retries_total'][2].append(f'api_retries_total{_labels(**labels)} {endpoint_metrics.retries}')
+            families['api_sent_bytes_total'][2].append(f'api_sent_bytes_total{_labels(**labels)} {endpoint_metrics.bytes_out}')
+            families['api_received_bytes_total'][2].append(f'api_received_bytes_total{_labels(**labels)} {endpoint_metrics.bytes_in}')
+            histogram = families['api_request_duration_seconds'][2]
+            for bound, count in zip(EndpointMetrics.LATENCY_BUCKETS + ['+Inf'], endpoint_metrics.cumulative_latency_counts()):
+                histogram.append(f'api_request_duration_seconds_bucket{_labels(**labels, le=bound)} {count}')
+            histogram.append(f'api_request_duration_seconds_sum{_labels(**labels)} {endpoint_metrics.latency_sum}')
+            histogram.append(f'api_request_duration_seconds_count{_labels(**labels)} {endpoint_metrics.requests}')
+
+    lines = []
+    for name, (metric_type, description, samples) in families.items():
+        lines.extend([f'# HELP {name} {description}', f'# TYPE {name} {metric_type}'] + samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(json_file=None, prometheus_file=None, *all_metrics: RequestMetrics):
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(json_summary(*all_metrics), f, indent=2)
+        print(f'Request metrics saved to {json_file}')
+    if prometheus_file:
+        with open(prometheus_file, 'w') as f:
+            f.write(prometheus_text(*all_metrics))
+        print(f'Request metrics saved to {prometheus_file}')
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from request_metrics import RequestMetrics
+
+
+class TokenBucket():
+    # Token bucket whose refill rate adapts: halved on throttling signals, slowly restored afterwards.
+    # Without a rate the host is unthrottled, only the pauses asked for by the server apply.
+    _base_rate: float
+    _capacity: float
+    _MIN_RATE = 0.05  # never slower than one request every 20 seconds.
+
+    def __init__(self, rate, capacity):
+        self._base_rate = rate
+        self._capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token and returns how long the caller has to wait before using it.
+        with self._lock:
+            now = time.monotonic()
+            if self.rate is None:
+                return max(0.0, self._paused_until - now)
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def slow_down(self):
+        with self._lock:
+            if self.rate is not None:
+                self.rate = max(self._MIN_RATE, self.rate / 2)
+
+    def recover(self):
+        with self._lock:
+            if self.rate is not None:
+                self.rate = min(self._base_rate, self.rate * 1.1)
+
+
+class RequestScheduler():
+    DEFAULT_API_RATE = 10.0  # requests per second, per API host (see limit_api_host), other hosts are unthrottled.
+    DEFAULT_BURST = 20
+    DEFAULT_MAX_RETRIES = 5
+    DEFAULT_BACKOFF_BASE = 1.0
+    DEFAULT_BACKOFF_MAX = 60.0
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+    USAGE_THRESHOLD = 80  # percent of the platform quota where requests start being slowed down.
+    _buckets: dict
+
+    def __init__(self, api_rate=DEFAULT_API_RATE, burst=DEFAULT_BURST, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX, host_rates={}):
+        self._api_rate = api_rate
+        self._burst = burst
+        self._host_rates = dict(host_rates)
+        self.max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def limit_api_host(self, url):
+        # Called by the clients for their API base URLs, so media downloads (e.g. the Instagram CDN) aren't capped by the API quota.
+        # A rate given through host_rates takes precedence.
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_rates:
+                self._host_rates[host] = self._api_rate
+                self._buckets.pop(host, None)  # an unthrottled bucket made before the registration.
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self._host_rates.get(host), self._burst)
+            return self._buckets[host]
+
+    def wait_time(self, url):
+        return self.bucket(url).reserve()
+
+    @staticmethod
+    def _retry_after(headers):
+        retry_after = headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                return None
+
+    @staticmethod
+    def _usage(headers):
+        # Graph API usage headers report percentages of the app/business quota already consumed.
+        usage = 0
+        regain_access_seconds = 0
+        for header in ['X-App-Usage', 'X-Ad-Account-Usage', 'X-Business-Use-Case-Usage']:
+            if header not in headers:
+                continue
+            try:
+                header_json = json.loads(headers[header])
+            except ValueError:
+                continue
+            entries = [entry for entries in header_json.values() for entry in entries] if header == 'X-Business-Use-Case-Usage' else [header_json]
+            for entry in entries:
+                usage = max([usage] + [value for key, value in entry.items() if key in ['call_count', 'total_time', 'total_cputime']])
+                regain_access_seconds = max(regain_access_seconds, entry.get('estimated_time_to_regain_access', 0) * 60)
+        return usage, regain_access_seconds
+
+    def observe(self, url, status, headers):
+        # Feeds a response back into its host's bucket: throttling signals slow it down, healthy responses restore it.
+        bucket = self.bucket(url)
+        usage, regain_access_seconds = self._usage(headers)
+        if regain_access_seconds > 0:
+            bucket.pause(regain_access_seconds)
+        if status == 429 or usage >= self.USAGE_THRESHOLD:
+            bucket.slow_down()
+        else:
+            bucket.recover()
+
+        retry_after = self._retry_after(headers)
+        if retry_after is not None and status in self.RETRY_STATUSES:
+            bucket.pause(retry_after)
+
+    def _retryable(self, method, status, headers):
+        if method.upper() in self.IDEMPOTENT_METHODS:
+            return status in self.RETRY_STATUSES
+        # Other 5xx may come after e.g. WordPress already created the post or media, replaying it would duplicate it.
+        # A 429, or a 503 asking to come back later, means the request was turned away.
+        return status == 429 or (status == 503 and self._retry_after(headers) is not None)
+
+    def retry_delay(self, method, status, headers, attempt):
+        # None when the response is final, otherwise how long to wait before the next attempt.
+        if not self._retryable(method, status, headers) or attempt >= self.max_retries:
+            return None
+        retry_after = self._retry_after(headers)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self._backoff_base)
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** attempt))  # full jitter.
+
+    @staticmethod
+    def _content_length(headers):
+        try:
+            return int(headers.get('Content-Length', 0))
+        except ValueError:
+            return 0
+
+    def request(self, session, method, url, on_unauthorized=None, build_body=None, metrics: RequestMetrics = None, endpoint=None, **kwargs):
+        # build_body returns (body kwargs, cleanup) per attempt, as streamed bodies can't be sent twice.
+        # on_unauthorized refreshes the credentials once and returns the headers to resend the request with.
+        # Every attempt is recorded in metrics under endpoint (defaults to the method and host, URLs may hold tokens).
+        endpoint = endpoint if endpoint else f'{method} {urlsplit(url).netloc}'
+        attempt = 0
+        refreshed = False
+        while True:
+            time.sleep(self.wait_time(url))
+            body, cleanup = build_body() if build_body else ({}, None)
+            request_kwargs = {**kwargs, **body, 'headers': {**kwargs.get('headers', {}), **body.get('headers', {})}}
+            started_at = time.perf_counter()
+            try:
+                response = session.request(method, url, **request_kwargs)
+            finally:
+                if cleanup:
+                    cleanup()
+            if metrics is not None:
+                # Streamed bodies aren't read yet, their size is the announced one.
+                bytes_in = self._content_length(response.headers) if request_kwargs.get('stream') else len(response.content)
+                metrics.record(endpoint, response.status_code, time.perf_counter() - started_at,
+                               self._content_length(response.request.headers), bytes_in)
+            self.observe(url, response.status_code, response.headers)
+
+            if response.status_code == 401 and on_unauthorized and not refreshed:
+                refreshed = True
+                if metrics is not None:
+                    metrics.record_retry(endpoint)
+                kwargs['headers'] = {**kwargs.get('headers', {}), **on_unauthorized()}
+                response.close()
+                continue
+
+            delay = self.retry_delay(method, response.status_code, response.headers, attempt)
+            if delay is None:
+                return response
+
+            print(f'Request to {urlsplit(url).netloc} returned {response.status_code}, retrying in {delay:.1f}s.')
+            if metrics is not None:
+                metrics.record_retry(endpoint)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def request_async(self, session, method, url, on_unauthorized=None, build_body=None, metrics: RequestMetrics = None, endpoint=None,
+                            **kwargs):
+        # aiohttp counterpart of request; on_unauthorized is a coroutine function. The caller releases the response.
+        endpoint = endpoint if endpoint else f'{method} {urlsplit(url).netloc}'
+        attempt = 0
+        refreshed = False
+        while True:
+            await asyncio.sleep(self.wait_time(url))
+            body, cleanup = build_body() if build_body else ({}, None)
+            request_kwargs = {**kwargs, **body, 'headers': {**kwargs.get('headers', {}), **body.get('headers', {})}}
+            started_at = time.perf_counter()
+            try:
+                response = await session.request(method, url, **request_kwargs)
+            finally:
+                if cleanup:
+                    cleanup()
+            if metrics is not None:
+                # Bodies are read by the caller, their size is the announced one.
+                metrics.record(endpoint, response.status, time.perf_counter() - started_at,
+                               self._content_length(response.request_info.headers), self._content_length(response.headers))
+            self.observe(url, response.status, response.headers)
+
+            if response.status == 401 and on_unauthorized and not refreshed:
+                refreshed = True
+                if metrics is not None:
+                    metrics.record_retry(endpoint)
+                response.release()
+                kwargs['headers'] = {**kwargs.get('headers', {}), **(await on_unauthorized())}
+                continue
+
+            delay = self.retry_delay(method, response.status, response.headers, attempt)
+            if delay is None:
+                return response
+
+            print(f'Request to {urlsplit(url).netloc} returned {response.status}, retrying in {delay:.1f}s.')
+            if metrics is not None:
+                metrics.record_retry(endpoint)
+            response.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+_shared_scheduler: RequestScheduler = None
+
+
+def get_shared_scheduler():
+    global _shared_scheduler
+    if _shared_scheduler is None:
+        _shared_scheduler = RequestScheduler()
+    return _shared_scheduler
+
+
+def scheduler_from_env():
+    # Rate limiting/retry settings shared by every entry point (sync, async and multi-account).
+    return RequestScheduler(api_rate=float(os.environ.get('API_REQUESTS_PER_SECOND', RequestScheduler.DEFAULT_API_RATE)),
+                            max_retries=int(os.environ.get('API_MAX_RETRIES', RequestScheduler.DEFAULT_MAX_RETRIES)))
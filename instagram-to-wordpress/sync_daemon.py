@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+import signal
+import threading
+import time
+from requests import RequestException
+
+
+class BackgroundTokenRefresher():
+    # Renews the clients' tokens ahead of expiry from a daemon thread, so a sync cycle never waits on (or fails for) a stale token.
+    DEFAULT_CHECK_INTERVAL = 60 * 60  # seconds.
+    _clients: list
+    _check_interval: float
+    _stop_event: threading.Event
+    _thread: threading.Thread
+
+    def __init__(self, clients, check_interval=DEFAULT_CHECK_INTERVAL):
+        self._clients = list(clients)
+        self._check_interval = check_interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self._check_interval):
+            for client in self._clients:
+                try:
+                    client.refresh_token_if_needed()
+                except (SystemExit, RequestException) as err:  # the clients exit(1) on API errors, the next check tries again.
+                    print(f'Could not refresh the {type(client).__name__} token, retrying in {self._check_interval}s: {err}')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def watch(sync, poll_interval):
+    # Runs sync() every poll_interval seconds (measured from the start of each cycle) until SIGINT/SIGTERM.
+    # A failed cycle is reported and retried on the next one, nothing already migrated is lost thanks to the ledger.
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f'Received {signal.Signals(signum).name}, stopping after the current cycle.')
+        stop_event.set()
+
+    previous_handlers = {signum: signal.signal(signum, request_stop) for signum in [signal.SIGINT, signal.SIGTERM]}
+    try:
+        while not stop_event.is_set():
+            cycle_started_at = time.monotonic()
+            try:
+                sync()
+            except (SystemExit, RequestException) as err:
+                print(f'Sync cycle failed, retrying in {poll_interval}s: {err}')
+            stop_event.wait(max(0.0, poll_interval - (time.monotonic() - cycle_started_at)))
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class LedgerEntry():
+    def __init__(self, instagram_media_id, status, wordpress_media_ids, wordpress_post_id):
+        self.instagram_media_id: str = instagram_media_id
+        self.status: str = status
+        self.wordpress_media_ids: list = json.loads(wordpress_media_ids) if wordpress_media_ids else []
+        self.wordpress_post_id: int = wordpress_post_id
+
+
+class SyncLedger():
+    FETCHED = 'fetched'
+    MEDIA_UPLOADED = 'media_uploaded'
+    POST_CREATED = 'post_created'
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+
+    def __init__(self, ledger_file='sync_ledger.db'):
+        self._connection = sqlite3.connect(ledger_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS ledger (
+                                            instagram_media_id TEXT PRIMARY KEY,
+                                            status TEXT NOT NULL,
+                                            wordpress_media_ids TEXT,
+                                            wordpress_post_id INTEGER,
+                                            updated_at REAL NOT NULL)''')
+            # Every image (carousel child or single image) as soon as it's uploaded, so a post failing halfway keeps the others.
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS uploaded_images (
+                                            instagram_image_id TEXT PRIMARY KEY,
+                                            wordpress_media_id INTEGER NOT NULL,
+                                            updated_at REAL NOT NULL)''')
+
+    def _record(self, instagram_media_id, status, wordpress_media_ids=None, wordpress_post_id=None):
+        # Every step is its own transaction, so a crash loses at most the step in progress.
+        with self._lock, self._connection:
+            self._connection.execute('''INSERT INTO ledger (instagram_media_id, status, wordpress_media_ids, wordpress_post_id, updated_at)
+                                        VALUES (?, ?, ?, ?, ?)
+                                        ON CONFLICT (instagram_media_id) DO UPDATE SET
+                                            status = excluded.status,
+                                            wordpress_media_ids = COALESCE(excluded.wordpress_media_ids, wordpress_media_ids),
+                                            wordpress_post_id = COALESCE(excluded.wordpress_post_id, wordpress_post_id),
+                                            updated_at = excluded.updated_at''',
+                                     (instagram_media_id, status,
+                                      json.dumps(wordpress_media_ids) if wordpress_media_ids is not None else None,
+                                      wordpress_post_id, datetime.now().timestamp()))
+
+    def record_fetched(self, instagram_media_id):
+        self._record(instagram_media_id, self.FETCHED)
+
+    def record_media_uploaded(self, instagram_media_id, wordpress_media_ids):
+        self._record(instagram_media_id, self.MEDIA_UPLOADED, wordpress_media_ids=wordpress_media_ids)
+
+    def record_post_created(self, instagram_media_id, wordpress_post_id):
+        self._record(instagram_media_id, self.POST_CREATED, wordpress_post_id=wordpress_post_id)
+
+    def record_image_uploaded(self, instagram_image_id, wordpress_media_id):
+        with self._lock, self._connection:
+            self._connection.execute('''INSERT OR REPLACE INTO uploaded_images (instagram_image_id, wordpress_media_id, updated_at)
+                                        VALUES (?, ?, ?)''', (instagram_image_id, wordpress_media_id, datetime.now().timestamp()))
+
+    def uploaded_image(self, instagram_image_id):
+        with self._lock:
+            row = self._connection.execute('SELECT wordpress_media_id FROM uploaded_images WHERE instagram_image_id = ?',
+                                           (instagram_image_id,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, instagram_media_id):
+        with self._lock:
+            row = self._connection.execute('''SELECT instagram_media_id, status, wordpress_media_ids, wordpress_post_id
+                                              FROM ledger WHERE instagram_media_id = ?''', (instagram_media_id,)).fetchone()
+        return LedgerEntry(*row) if row else None
+
+    def completed_media_ids(self):
+        with self._lock:
+            rows = self._connection.execute('SELECT instagram_media_id FROM ledger WHERE status = ?', (self.POST_CREATED,)).fetchall()
+        return {row[0] for row in rows}
+
+    def close(self):
+        self._connection.close()
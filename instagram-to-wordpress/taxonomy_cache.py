@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import html
+import io
+import json
+import os
+import threading
+
+
+class TermCache():
+    TAXONOMIES = ['categories', 'tags']
+    _terms: dict
+    _cache_file: str
+    _lock: threading.Lock
+
+    def __init__(self, cache_file=None):
+        self._terms = {taxonomy: {} for taxonomy in self.TAXONOMIES}
+        self._cache_file = cache_file
+        self._lock = threading.Lock()
+
+        if cache_file and os.path.exists(cache_file):
+            with io.open(cache_file, encoding='utf-8') as f:
+                for taxonomy, terms in json.load(f).items():
+                    self._terms.setdefault(taxonomy, {}).update(terms)
+
+    @staticmethod
+    def normalize(name):
+        # WordPress returns names HTML-escaped (e.g. "&amp;") and matches them case-insensitively.
+        return html.unescape(str(name)).strip().lower()
+
+    def is_empty(self):
+        return not any(self._terms.values())
+
+    def get(self, taxonomy, name):
+        return self._terms.get(taxonomy, {}).get(self.normalize(name))
+
+    def add(self, taxonomy, terms_json, persist=True):
+        with self._lock:
+            terms = self._terms.setdefault(taxonomy, {})
+            for term in terms_json:
+                terms[self.normalize(term['name'])] = term['id']
+                if 'slug' in term:
+                    terms.setdefault(self.normalize(term['slug']), term['id'])
+        if persist:
+            self.save()
+
+    def save(self):
+        if not self._cache_file:
+            return
+
+        with self._lock:
+            json_data = json.dumps(self._terms, ensure_ascii=False, indent=2)
+        # Written next to the target then renamed, so a crash never leaves a truncated cache.
+        temp_file = f'{self._cache_file}.tmp'
+        with io.open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(json_data)
+        os.replace(temp_file, self._cache_file)
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+import io
+import json
+import os
+import threading
+from datetime import datetime
+
+
+class TokenStore():
+    # Persists an access token and its expiration between runs, for the account (identity) it was issued to.
+    _token_file: str
+    _lock: threading.Lock
+
+    def __init__(self, token_file=None):
+        self._token_file = token_file
+        self._lock = threading.Lock()
+
+    def load(self, identity, refresh_margin=0):
+        # Returns (access token, expiration timestamp or None), or (None, None) when missing, for another account or expiring.
+        if not self._token_file or not os.path.exists(self._token_file):
+            return None, None
+
+        with self._lock, io.open(self._token_file, encoding='utf-8') as f:
+            try:
+                token_json = json.load(f)
+            except ValueError:
+                return None, None
+
+        expiration_date = token_json.get('expiration_date')
+        if token_json.get('identity') != identity or 'access_token' not in token_json:
+            return None, None
+        if expiration_date is not None and expiration_date - datetime.now().timestamp() <= refresh_margin:
+            return None, None
+        return token_json['access_token'], expiration_date
+
+    def save(self, identity, access_token, expiration_date=None):
+        if not self._token_file:
+            return
+
+        json_data = json.dumps({'identity': identity, 'access_token': access_token, 'expiration_date': expiration_date}, indent=2)
+        # Written next to the target then renamed, so a crash never leaves a truncated file; only readable by its owner.
+        temp_file = f'{self._token_file}.tmp'
+        with self._lock:
+            with io.open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+                f.write(json_data)
+            os.replace(temp_file, self._token_file)
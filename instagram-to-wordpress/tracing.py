@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+import cProfile
+import functools
+import inspect
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer():
+    # Records spans as Chrome trace "complete" events, the JSON opens in chrome://tracing and https://ui.perfetto.dev
+    # with one track per thread (pipeline workers included). A disabled tracer records and instruments nothing.
+    enabled: bool
+    _events: list
+    _thread_names: dict
+    _lock: threading.Lock
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._events = []
+        self._thread_names = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category='stage', **args):
+        if not self.enabled:
+            yield
+            return
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, category, started_at, time.perf_counter(), args)
+
+    def _record(self, name, category, started_at, ended_at, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round(started_at * 1e6, 3), 'dur': round((ended_at - started_at) * 1e6, 3),
+                 'pid': os.getpid(), 'tid': thread.ident}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            self._thread_names.setdefault(thread.ident, thread.name)
+
+    def instrument(self, obj, category, method_names):
+        # Replaces the methods on the instance only, so calls made through self (e.g. from the client's own methods) are traced too.
+        # Spans of generator methods cover the production of each item, not the time the caller spends on it.
+        if not self.enabled:
+            return
+        for method_name in method_names:
+            method = getattr(obj, method_name, None)
+            if method is None:
+                continue
+            name = f'{type(obj).__name__}.{method_name}'
+            setattr(obj, method_name, self._traced_generator(method, name, category) if inspect.isgeneratorfunction(method)
+                    else self._traced(method, name, category))
+
+    def _traced(self, method, name, category):
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            with self.span(name, category):
+                return method(*args, **kwargs)
+        return traced
+
+    def _traced_generator(self, method, name, category):
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            iterator = method(*args, **kwargs)
+            while True:
+                with self.span(name, category):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+        return traced
+
+    def save(self, trace_file):
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread_name}}
+                        for tid, thread_name in self._thread_names.items()]
+            trace_json = json.dumps({'traceEvents': metadata + self._events, 'displayTimeUnit': 'ms'})
+        with open(trace_file, 'w') as f:
+            f.write(trace_json)
+        print(f'Trace saved to {trace_file} ({len(self._events)} spans)')
+
+
+class ThreadProfiler():
+    # cProfile of the main thread and of every thread started while enabled (pipeline workers, prefetching).
+    # Since Python 3.12 cProfile relies on sys.monitoring, which already covers every thread with a single profile.
+    _profiles: list
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._profiles = [cProfile.Profile()]
+        self._lock = threading.Lock()
+
+    def _profile_new_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()  # replaces this hook for the thread.
+
+    def enable(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_new_thread)
+        self._profiles[0].enable()
+
+    def dump(self, profile_file):
+        self._profiles[0].disable()
+        threading.setprofile(None)
+        with self._lock:
+            stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(profile_file)
+        print(f'CPU profile saved to {profile_file} (e.g. python -m pstats {profile_file})')
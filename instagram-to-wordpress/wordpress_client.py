@@ -1,8 +1,12 @@
 #!/usr/bin/python3
 
-
+import threading
 from datetime import datetime
-import requests
+from http_session import STREAM_CHUNK_SIZE, PooledSession, StreamingBody, get_shared_session
+from request_metrics import RequestMetrics
+from request_scheduler import RequestScheduler, get_shared_scheduler
+from taxonomy_cache import TermCache
+from token_store import TokenStore
 
 
 class WordpressClient():
@@ -12,28 +16,132 @@ class WordpressClient():
     _application_password: str
     _site: str
     _access_token: str
+    _session: PooledSession
+    _term_cache: TermCache
+    _scheduler: RequestScheduler
+    metrics: RequestMetrics
+    _token_store: TokenStore
+    _expiration_date: float
+    _token_lock: threading.Lock
+    TOKEN_REFRESH_MARGIN = 5 * 60  # seconds before expiration when the token is renewed.
+    MAX_BATCH_SIZE = 25  # sub-requests per /batch/v1 call allowed by WordPress.
+    _batch_url: str
+    _batch_supported: bool
+    _REST_NAMESPACE = '/wp/v2'
     _BASE_API_PATH = 'https://public-api.wordpress.com/wp/v2/sites'
+    _OAUTH_TOKEN_URL = 'https://public-api.wordpress.com/oauth2/token'
 
-    def __init__(self, client_id, client_secret, username, application_password, site):
+    def __init__(self, client_id, client_secret, username, application_password, site, session: PooledSession = None, term_cache: TermCache = None,
+                 scheduler: RequestScheduler = None, base_api_path=None, oauth_token_url=None, metrics: RequestMetrics = None,
+                 token_store: TokenStore = None, batch_url=None):
         self._client_id = client_id
         self._client_secret = client_secret
         self._username = username
         self._application_password = application_password
         self._site = site
-        self._authenticate_user()
+        self._session = session if session else get_shared_session()
+        self._term_cache = term_cache if term_cache else TermCache()
+        self._scheduler = scheduler if scheduler else get_shared_scheduler()
+        self.metrics = metrics if metrics else RequestMetrics('wordpress')
+        if base_api_path:
+            self._BASE_API_PATH = base_api_path  # e.g. a local stand-in server for benchmarks.
+        if oauth_token_url:
+            self._OAUTH_TOKEN_URL = oauth_token_url
+        self._token_store = token_store if token_store else TokenStore()
+        self._token_lock = threading.Lock()
+        self._batch_url = batch_url if batch_url else f'{self._BASE_API_PATH}/{site}/batch/v1'
+        self._batch_supported = True  # until the site says otherwise.
+        for api_url in [self._BASE_API_PATH, self._OAUTH_TOKEN_URL, self._batch_url]:
+            self._scheduler.limit_api_host(api_url)
+
+        # A token saved by an earlier run for the same account is reused, saving the password grant round trip.
+        self._access_token, self._expiration_date = self._token_store.load(self.token_identity(self._OAUTH_TOKEN_URL, client_id, username, site),
+                                                                           self.TOKEN_REFRESH_MARGIN)
+        if self._access_token is None:
+            self._authenticate_user()
+        else:
+            print('Reusing saved Wordpress access token.')
+
+    @staticmethod
+    def token_identity(oauth_token_url, client_id, username, site):
+        return f'{oauth_token_url}|{client_id}|{username}|{site}'
 
     @property
     def auth_header(self):
         return {'Authorization': f'Bearer {self._access_token}'}
 
-    def _refresh_token(self):
-        print('Access token will be renewed.')
-        self._authenticate_user()
+    def _token_expiring(self):
+        return self._expiration_date is not None and self._expiration_date - datetime.now().timestamp() <= self.TOKEN_REFRESH_MARGIN
+
+    def refresh_token_if_needed(self):
+        # Checked before every request, the lock is only taken once the token is about to expire.
+        if not self._token_expiring():
+            return
+        with self._token_lock:
+            if self._token_expiring():
+                print('Access token will be renewed.')
+                self._authenticate_user()
+
+    def _refresh_token(self, stale_token):
+        # Many workers may hit a 401 at once, only the first one re-authenticates and the others reuse its token.
+        with self._token_lock:
+            if self._access_token == stale_token:
+                print('Access token will be renewed.')
+                self._authenticate_user()
+        return self.auth_header
+
+    def _request(self, method, path, build_body=None, headers={}, **kwargs):
+        return self._request_url(method, f'{self._BASE_API_PATH}/{self._site}/{path}', f'{method} {path}', build_body, headers, **kwargs)
+
+    def _request_url(self, method, url, endpoint, build_body=None, headers={}, **kwargs):
+        # Rate limited and retried by the scheduler; a 401 refreshes the token once and returns the retried response.
+        self.refresh_token_if_needed()
+        access_token = self._access_token
+        return self._scheduler.request(self._session, method, url,
+                                       on_unauthorized=lambda: self._refresh_token(access_token), build_body=build_body,
+                                       metrics=self.metrics, endpoint=endpoint,
+                                       headers={'Authorization': f'Bearer {access_token}', **headers}, **kwargs)
+
+    def _batch(self, sub_requests):
+        # Sends [(method, path, body)] write requests through /batch/v1, MAX_BATCH_SIZE per call, and returns their
+        # [(status, body)] in order. None marks a request the site wouldn't batch, for the caller to send on its own;
+        # once that happens batching stays off for this client.
+        results = []
+        for start in range(0, len(sub_requests), self.MAX_BATCH_SIZE):
+            chunk = sub_requests[start:start + self.MAX_BATCH_SIZE]
+            if not self._batch_supported:
+                results.extend([None] * len(chunk))
+                continue
+
+            batch_response = self._request_url('POST', self._batch_url, 'POST batch',
+                                               json={'validation': 'normal',
+                                                     'requests': [{'method': method, 'path': f'{self._REST_NAMESPACE}/{path}', 'body': body}
+                                                                  for method, path, body in chunk]})
+            if batch_response.status_code in [404, 405, 501]:  # no batch route (WordPress < 5.6 or a proxy in the way).
+                print(f'Batch requests are not available [{batch_response.url}], sending one request per item instead.')
+                self._batch_supported = False
+                results.extend([None] * len(chunk))
+                continue
+
+            batch_json = batch_response.json()
+            if batch_response.status_code not in [200, 207]:
+                print(f'Error while trying to send batch request [{batch_response.url}]: {batch_json}')
+                exit(1)
+
+            for sub_response in batch_json['responses']:
+                sub_body = sub_response.get('body')
+                if isinstance(sub_body, dict) and sub_body.get('code') == 'rest_batch_not_allowed':
+                    self._batch_supported = False
+                    results.append(None)
+                else:
+                    results.append((sub_response.get('status'), sub_body))
+        return results
 
     def _authenticate_user(self):
-        token_response = requests.post('https://public-api.wordpress.com/oauth2/token',
-                                       {'client_id': self._client_id, 'client_secret': self._client_secret,
-                                        'grant_type': 'password', 'username': self._username, 'password': self._application_password})
+        token_response = self._scheduler.request(self._session, 'POST', self._OAUTH_TOKEN_URL,
+                                                 metrics=self.metrics, endpoint='oauth token',
+                                                 data={'client_id': self._client_id, 'client_secret': self._client_secret,
+                                                       'grant_type': 'password', 'username': self._username, 'password': self._application_password})
         token_json = token_response.json()
 
         if token_response.status_code != 200:
@@ -45,64 +153,120 @@ class WordpressClient():
             print(
                 f'Missing one or more required keys ({required_keys}) from response of token request: {token_json}')
             exit(1)
-        print(f'Wordpress Token: {token_json}')
         self._access_token = token_json['access_token']
+        # WordPress.com tokens usually don't expire; when they don't say, they are only renewed after a 401.
+        self._expiration_date = datetime.now().timestamp() + token_json['expires_in'] if 'expires_in' in token_json else None
+        self._token_store.save(self.token_identity(self._OAUTH_TOKEN_URL, self._client_id, self._username, self._site),
+                               self._access_token, self._expiration_date)
 
-    def upload_post_media(self, file_path, caption, alt_text, description, post_id = None, self_call = False):
-        media_response = requests.post(f'{self._BASE_API_PATH}/{self._site}/media',
-                                       headers=self.auth_header,
-                                       data={'date': datetime.now(), 'alt_text': alt_text, 'caption': caption, 'description': description,
-                                             'post': post_id if post_id else 0},
-                                       files={'file': open(file_path, "rb"), 'caption': caption})
-        
-        if media_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.upload_post_media(file_path, caption, alt_text, description, post_id, True)
+    def upload_post_media(self, file_path, caption, alt_text, description, post_id = None):
+        with open(file_path, 'rb') as file:
+            def build_body():
+                file.seek(0)
+                return {'files': {'file': file, 'caption': caption}}, None
+
+            media_response = self._request('POST', 'media', build_body,
+                                           data={'date': datetime.now(), 'alt_text': alt_text, 'caption': caption, 'description': description,
+                                                 'post': post_id if post_id else 0})
+        media_json = media_response.json()
+
+        if media_response.status_code not in [200, 201]:
+            print(f'Error while trying to upload media [{media_response.url}]: {media_json}')
+            exit(1)
+
+        print(f'Media uploaded: {media_json["id"]}')
+        return media_json
+
+    def upload_post_media_stream(self, open_stream, filename, caption, alt_text, description, post_id = None, on_chunk = None):
+        # open_stream returns a streamed requests response (e.g. InstagramClient.open_media_stream), which is piped
+        # as the raw request body so the media never touches the disk. Metadata goes in the query string.
+        # on_chunk, when given, sees every chunk sent (e.g. to hash the content on the fly).
+        # Each attempt (token refresh, retries) re-opens the stream from the start.
+        def build_body():
+            source = open_stream()
+            chunks = source.iter_content(STREAM_CHUNK_SIZE)
+            if on_chunk:
+                chunks = self._observed_chunks(chunks, on_chunk)
+            content_length = 0 if 'Content-Encoding' in source.headers else int(source.headers.get('Content-Length', 0))
+            return {'headers': {'Content-Type': source.headers.get('Content-Type', 'application/octet-stream'),
+                                'Content-Disposition': f'attachment; filename="{filename}"'},
+                    'data': StreamingBody(chunks, content_length)}, source.close
+
+        media_response = self._request('POST', 'media', build_body,
+                                       params={'date': datetime.now(), 'alt_text': alt_text, 'caption': caption, 'description': description,
+                                               'post': post_id if post_id else 0})
         media_json = media_response.json()
 
         if media_response.status_code not in [200, 201]:
             print(f'Error while trying to upload media [{media_response.url}]: {media_json}')
             exit(1)
 
-        print(f'Media Data: {media_json}')
+        print(f'Media uploaded: {media_json["id"]}')
         return media_json
 
-    def create_post(self, title, content, categories = [], tags=[], date = datetime.now(), author = None, post_medias_path = [], self_call =  False):
-        media_ids = []
+    @staticmethod
+    def _observed_chunks(chunks, on_chunk):
+        for chunk in chunks:
+            on_chunk(chunk)
+            yield chunk
+
+    def create_post(self, title, content, categories = [], tags=[], date = datetime.now(), author = None, post_medias_path = [], media_ids = []):
+        # Medias already uploaded (e.g. by the pipelined migration) are passed through media_ids.
+        media_ids = list(media_ids)
         for media_path in post_medias_path:
             media_data = self.upload_post_media(media_path, f'{title}', f'{title}', f'Media uploaded for post titled: {title}')
             media_id = media_data['id']  # get the media ID from the response
             media_ids.append(media_id)
 
-        # Create a gallery with the uploaded media IDs
-        gallery_shortcode = f'[gallery ids="{",".join(map(str, media_ids))}"]'
-        content = f'{gallery_shortcode}{content}'  # add the gallery to the post content
-        post_response = requests.post(f'{self._BASE_API_PATH}/{self._site}/posts',
-                                      headers=self.auth_header,
-                                      data={'date': date, 'status': 'publish', 'format': 'standard',
-                                            'title': title, 'content': content, 'comment_status': 'open',
-                                            'author': self.get_author_id(author) if author else None,
-                                            'categories': ','.join([str(self.retrieve_or_create_category_id(category)) for category in categories]),
-                                            'tags': ','.join([str(self.retrieve_or_create_tag_id(tag)) for tag in tags])})
-        
-        if post_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.create_post(title, content, categories, tags, author, post_medias_path, True)
-        post_json = post_response.json()
-
-        if post_response.status_code not in [200, 201]:
-            print(f'Error while trying to create post [{post_response.url}]: {post_json}')
+        post_json = self.create_posts([{'title': title, 'content': content, 'categories': categories, 'tags': tags, 'date': date,
+                                        'author': author, 'media_ids': media_ids}])[0]
+        if post_json is None:
             exit(1)
+        return post_json
 
-        print(f'Post Data: {post_json}')
+    def create_posts(self, posts):
+        # posts are create_post keyword arguments (with already uploaded media_ids), created in order. Several posts
+        # go in batch requests, and the terms of all of them are resolved together.
+        # Returns the created post JSON per post, None for a post that failed and for the ones not sent after it; the
+        # caller records the created ones before failing, as a batch can't be undone.
+        term_ids = self.resolve_term_ids({'categories': [category for post in posts for category in post.get('categories', [])],
+                                          'tags': [tag for post in posts for tag in post.get('tags', [])]})
+        posts_data = []
+        for post in posts:
+            # Create a gallery with the uploaded media IDs
+            gallery_shortcode = f'[gallery ids="{",".join(map(str, post.get("media_ids", [])))}"]'
+            date = post.get('date', datetime.now())
+            post_data = {'date': date.isoformat() if isinstance(date, datetime) else date, 'status': 'publish', 'format': 'standard',
+                         'title': post['title'], 'content': f'{gallery_shortcode}{post["content"]}',  # add the gallery to the post content
+                         'comment_status': 'open', 'author': self.get_author_id(post['author']) if post.get('author') else None,
+                         'categories': list(dict.fromkeys(term_ids['categories'][category] for category in post.get('categories', []))),
+                         'tags': list(dict.fromkeys(term_ids['tags'][tag] for tag in post.get('tags', [])))}
+            posts_data.append({key: value for key, value in post_data.items() if value is not None})  # JSON null isn't a valid author.
 
-    def get_author_id(self, author, self_call = False):
-        author_response = requests.get(f'{self._BASE_API_PATH}/{self._site}/users?search={author}',
-                                    headers=self.auth_header)
-        
-        if author_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.get_author_id(author, True)
+        results = self._batch([('POST', 'posts', post_data) for post_data in posts_data]) if len(posts_data) > 1 else [None]
+        posts_json = []
+        failed = False
+        for post_data, result in zip(posts_data, results):
+            if result is None:
+                if failed:  # posts sent one by one stop at the first failure, to keep their order.
+                    posts_json.append(None)
+                    continue
+                post_response = self._request('POST', 'posts', json=post_data)
+                result = post_response.status_code, post_response.json()
+
+            post_status, post_json = result
+            if post_status not in [200, 201]:
+                print(f'Error while trying to create post "{post_data["title"]}": {post_json}')
+                failed = True
+                posts_json.append(None)
+                continue
+
+            print(f'Post created: {post_json["id"]}')
+            posts_json.append(post_json)
+        return posts_json
+
+    def get_author_id(self, author):
+        author_response = self._request('GET', 'users', params={'search': author})
         author_json = author_response.json()
 
         if author_response.status_code != 200:
@@ -115,76 +279,109 @@ class WordpressClient():
 
         return author_json[0]['id']
     
-    def retrieve_or_create_category_id(self, category, self_call = False):
-        category_id = self.get_category_id(category)
-        if category_id is not None:
-            return category_id
-        
-        # New category, so create it.
-        category_response = requests.post(f'{self._BASE_API_PATH}/{self._site}/categories',
-                                    headers=self.auth_header,
-                                    data={'name': category})
-        
-        if category_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.get_category_id(category, True)
-        category_json = category_response.json()
+    def _iter_collection(self, collection, params={}, per_page=100):
+        # Pages through a REST collection using the X-WP-TotalPages header.
+        page = 1
+        total_pages = 1
+        while page <= total_pages:
+            collection_response = self._request('GET', collection, params={**params, 'per_page': per_page, 'page': page})
+            collection_json = collection_response.json()
 
-        if category_response.status_code not in [200, 201]:
-            print(f'Error while trying to create category [{category_response.url}]: {category_json}')
-            exit(1)
+            if collection_response.status_code != 200:
+                print(f'Error while trying to list {collection} [{collection_response.url}]: {collection_json}')
+                exit(1)
 
-        print(f'Category Data: {category_json}')
-        return category_json['id']
+            yield from collection_json
+            total_pages = int(collection_response.headers.get('X-WP-TotalPages', page))
+            page += 1
 
-    def get_category_id(self, category, self_call = False):
-        category_response = requests.get(f'{self._BASE_API_PATH}/{self._site}/categories?search={category}',
-                                    headers=self.auth_header)
-        
-        if category_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.retrieve_or_create_category_id(category, True)
-        category_json = category_response.json()
+    def iter_media(self):
+        return self._iter_collection('media', {'_fields': 'id,source_url'})
 
-        if category_response.status_code != 200:
-            print(f'Error while trying to retrieve category [{category_response.url}]: {category_json}')
-            exit(1)
+    def warm_term_cache(self, per_page=100):
+        # Bulk-lists every category and tag once so hashtag lookups are answered from the cache.
+        for taxonomy in TermCache.TAXONOMIES:
+            self._term_cache.add(taxonomy, self._iter_collection(taxonomy, {'_fields': 'id,name,slug'}, per_page), persist=False)
+        self._term_cache.save()
 
-        return category_json[0]['id'] if len(category_json) != 0 else None
-    
-    def retrieve_or_create_tag_id(self, tag, self_call = False):
-        tag_id = self.get_tag_id(tag)
-        if tag_id is not None:
-            return tag_id
-
-        # New tag, so create it.
-        tag_response = requests.post(f'{self._BASE_API_PATH}/{self._site}/tags',
-                                    headers=self.auth_header,
-                                    data={'name': tag})
-        
-        if tag_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.retrieve_or_create_tag_id(tag, True)
-        tag_json = tag_response.json()
+    def resolve_term_ids(self, names_by_taxonomy):
+        # Maps {taxonomy: [names]} to {taxonomy: {name: id}}, creating missing terms. Instead of a search and a create
+        # per name: one slug lookup per taxonomy for the names not cached yet, then one batch creating the rest.
+        missing = {}
+        for taxonomy, names in names_by_taxonomy.items():
+            uncached = [name for name in dict.fromkeys(names) if self._term_cache.get(taxonomy, name) is None]
+            for start in range(0, len(uncached), 100):
+                self._term_cache.add(taxonomy, list(self._iter_collection(taxonomy, {'slug': ','.join(uncached[start:start + 100]),
+                                                                                     '_fields': 'id,name,slug'})))
+            missing[taxonomy] = [name for name in uncached if self._term_cache.get(taxonomy, name) is None]
 
-        if tag_response.status_code not in [200, 201]:
-            print(f'Error while trying to create tag [{tag_response.url}]: {tag_json}')
+        sub_requests = [(taxonomy, name) for taxonomy, names in missing.items() for name in names]
+        results = self._batch([('POST', taxonomy, {'name': name}) for taxonomy, name in sub_requests]) if sub_requests else []
+        for (taxonomy, name), result in zip(sub_requests, results):
+            if result is None:
+                self._retrieve_or_create_term_id(taxonomy, name)
+                continue
+
+            term_status, term_json = result
+            # Term created meanwhile (or its slug differs from its name): WordPress reports its id.
+            if term_status == 400 and term_json.get('code') == 'term_exists':
+                self._term_cache.add(taxonomy, [{'id': term_json['data']['term_id'], 'name': name}])
+            elif term_status in [200, 201]:
+                print(f'Term created ({taxonomy}): {term_json["id"]} {term_json.get("name", name)}')
+                self._term_cache.add(taxonomy, [term_json])
+            else:
+                print(f'Error while trying to create {taxonomy} "{name}": {term_json}')
+                exit(1)
+
+        return {taxonomy: {name: self._term_cache.get(taxonomy, name) for name in names} for taxonomy, names in names_by_taxonomy.items()}
+
+    def _retrieve_or_create_term_id(self, taxonomy, name):
+        term_id = self._get_term_id(taxonomy, name)
+        if term_id is not None:
+            return term_id
+
+        # New term, so create it.
+        term_response = self._request('POST', taxonomy, data={'name': name})
+        term_json = term_response.json()
+
+        # Term created meanwhile (or missed by the search): WordPress reports its id.
+        if term_response.status_code == 400 and term_json.get('code') == 'term_exists':
+            term_id = term_json['data']['term_id']
+            self._term_cache.add(taxonomy, [{'id': term_id, 'name': name}])
+            return term_id
+
+        if term_response.status_code not in [200, 201]:
+            print(f'Error while trying to create {taxonomy} [{term_response.url}]: {term_json}')
             exit(1)
 
-        print(f'Tag Data: {tag_json}')
-        return tag_json['id']
+        print(f'Term created ({taxonomy}): {term_json["id"]} {term_json.get("name", name)}')
+        self._term_cache.add(taxonomy, [term_json])
+        return term_json['id']
 
-    def get_tag_id(self, tag, self_call = False):
-        tag_response = requests.get(f'{self._BASE_API_PATH}/{self._site}/tags?search={tag}',
-                                    headers=self.auth_header)
-        
-        if tag_response.status_code == 401 and not self_call:
-            self._refresh_token()
-            self.get_tag_id(tag, True)
-        tag_json = tag_response.json()
+    def _get_term_id(self, taxonomy, name):
+        term_id = self._term_cache.get(taxonomy, name)
+        if term_id is not None:
+            return term_id
+
+        term_response = self._request('GET', taxonomy, params={'search': name, 'per_page': 100})
+        term_json = term_response.json()
 
-        if tag_response.status_code != 200:
-            print(f'Error while trying to retrieve tag [{tag_response.url}]: {tag_json}')
+        if term_response.status_code != 200:
+            print(f'Error while trying to retrieve {taxonomy} [{term_response.url}]: {term_json}')
             exit(1)
 
-        return tag_json[0]['id'] if len(tag_json) != 0 else None
+        # search is fuzzy, so only an exact (normalized) name or slug match is accepted.
+        self._term_cache.add(taxonomy, term_json)
+        return self._term_cache.get(taxonomy, name)
+
+    def retrieve_or_create_category_id(self, category):
+        return self._retrieve_or_create_term_id('categories', category)
+
+    def get_category_id(self, category):
+        return self._get_term_id('categories', category)
+
+    def retrieve_or_create_tag_id(self, tag):
+        return self._retrieve_or_create_term_id('tags', tag)
+
+    def get_tag_id(self, tag):
+        return self._get_term_id('tags', tag)
@@ -2,71 +2,292 @@
 """
 meowport.py
 Script to download all the `:meow-` based emojis from the Slackmojis blob cats page and import them into a Discord server using the Discord API.
-No external dependencies required (uses only Python standard library).
+Requires python-dotenv for the .env configuration, and optionally Pillow to shrink emojis over Discord's 256 KB limit (see requirements.txt).
 """
 import os
 import re
-import urllib.request
-import html
+import urllib.parse
+import html.parser
+import codecs
 import http.client
 import json
 import dotenv
 import random
 import base64
 import time
+import argparse
+import threading
+import hashlib
+import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    from PIL import Image, ImageSequence
+except ImportError:  # Pillow is only needed to shrink emojis over Discord's size limit
+    Image = None
 
-SLACKMOJIS_URL = "https://slackmojis.com/categories/25-blob-cats-emojis"
+SLACKMOJIS_CATEGORY_URL = "https://slackmojis.com/categories/{category}"
+DEFAULT_CATEGORIES = ["25-blob-cats-emojis"]
+DEFAULT_NAME_FILTER = "meow"
 DOWNLOAD_DIR = "./downloaded"
+CACHE_DIR = "./http_cache"
+OPTIMIZED_DIR = "./optimized"
 
 # Discord API endpoint for uploading emojis
 DISCORD_API_URL = "https://discord.com/api/v10/guilds/{guild_id}/emojis"
+DISCORD_API_HOST = "discord.com"
+DISCORD_API_PATH = "/api/v10"
+PROGRESS_FILE = "./upload_progress.json"
+MAX_REQUEST_RETRIES = 5
+# Emoji slots per server boost tier (premium_tier), for static and animated emojis each
+EMOJI_SLOTS_BY_TIER = {0: 50, 1: 100, 2: 150, 3: 250}
+MAX_EMOJI_SIZE = 256 * 1024
+# Tried in order until an emoji fits in MAX_EMOJI_SIZE: (max width/height, palette colors or None to keep them all,
+# keep every n-th frame); Discord shows emojis at 128x128 at most
+STATIC_OPTIMIZE_STEPS = [(128, None, 1), (128, 256, 1), (96, 128, 1), (64, 64, 1), (48, 32, 1)]
+ANIMATED_OPTIMIZE_STEPS = [(128, 256, 1), (128, 128, 1), (96, 128, 1), (96, 64, 2), (64, 64, 2), (64, 32, 3), (48, 32, 4)]
 
-# Helper: Download a URL to a file
-def download_file(url, dest):
-    req = urllib.request.Request(
-        url,
-        headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-    )
-    with urllib.request.urlopen(req) as response, open(dest, 'wb') as out_file:
-        out_file.write(response.read())
-
-# Step 1: Scrape the Slackmojis page for :meow- emojis
-def fetch_meow_emojis():
-    req = urllib.request.Request(
-        SLACKMOJIS_URL,
-        headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-    )
-    with urllib.request.urlopen(req) as response:
-        html_content = response.read().decode('utf-8')
-    # Find all emoji <li> blocks (single quotes, robust)
-    emoji_blocks = re.findall(r"<li class='emoji[^']*'[^>]*>.*?</li>", html_content, re.DOTALL)
-    print(f"DEBUG: Found {len(emoji_blocks)} <li class='emoji'> blocks.")
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 3
+CHUNK_SIZE = 64 * 1024
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Each worker thread keeps one persistent connection per host (http.client connections aren't thread-safe)
+_thread_local = threading.local()
+
+def _connection(scheme, host):
+    connections = _thread_local.__dict__.setdefault('connections', {})
+    if (scheme, host) not in connections:
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        connections[(scheme, host)] = connection_class(host, timeout=30)
+    return connections[(scheme, host)]
+
+def close_connections():
+    for conn in _thread_local.__dict__.get('connections', {}).values():
+        conn.close()
+
+# Helper: GET a URL on the calling thread's keep-alive connection, following redirects like urlopen does
+def http_get(url, headers=None, max_redirects=5):
+    for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        conn = _connection(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", parts.path + (f"?{parts.query}" if parts.query else ""), headers={'User-Agent': USER_AGENT, **(headers or {})})
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()  # e.g. the server dropped the idle connection, the next request reconnects
+            raise
+        location = response.getheader('Location')
+        if response.status not in REDIRECT_STATUSES or not location:
+            return response
+        response.read()  # drained, so the connection can be reused
+        url = urllib.parse.urljoin(url, location)
+    raise http.client.HTTPException(f"Too many redirects for {url}")
+
+# Helper: On-disk cache of the ETag/Last-Modified validators of fetched URLs (index.json in cache_dir, with the page
+# bodies next to it), so unchanged pages and images are answered with a 304 instead of being downloaded again
+class HttpCache:
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, "pages"), exist_ok=True)
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def page_path(self, url):
+        return os.path.join(self.cache_dir, "pages", hashlib.sha256(url.encode('utf-8')).hexdigest() + ".html")
+
+    def entry(self, url, path):
+        # Only usable while the copy the validators describe is still on disk
+        with self._lock:
+            entry = self._entries.get(url)
+        if not entry or entry['path'] != path or not os.path.exists(path):
+            return None
+        return entry
+
+    def conditional_headers(self, url, path):
+        entry = self.entry(url, path) or {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, path, response, **extra):
+        entry = {'path': path, 'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified'), **extra}
+        with self._lock:
+            if entry['etag'] or entry['last_modified']:
+                self._entries[url] = entry
+            else:
+                self._entries.pop(url, None)
+
+    def save(self):
+        with self._lock:
+            index_json = json.dumps(self._entries, indent=2)
+        with open(f"{self.index_path}.part", 'w', encoding='utf-8') as f:
+            f.write(index_json)
+        os.replace(f"{self.index_path}.part", self.index_path)
+
+# Helper: Download a URL to a file, streamed in chunks and retried with backoff on network errors, 429s and 5xx
+# Returns False when the cache's copy was still up to date (304) and nothing was downloaded
+def download_file(url, dest, retries=DOWNLOAD_RETRIES, cache=None):
+    for attempt in range(retries + 1):
+        retry_after = None
+        try:
+            response = http_get(url, cache.conditional_headers(url, dest) if cache else None)
+            if response.status == 304:
+                response.read()
+                return False
+            if response.status == 200:
+                # Written next to the destination then renamed, so a failed download never leaves a truncated file
+                with open(f"{dest}.part", 'wb') as out_file:
+                    while chunk := response.read(CHUNK_SIZE):
+                        out_file.write(chunk)
+                os.replace(f"{dest}.part", dest)
+                if cache:
+                    cache.store(url, dest, response)
+                return True
+            response.read()
+            if response.status != 429 and response.status < 500:
+                raise http.client.HTTPException(f"{response.status} {response.reason} for {url}")
+            retry_after = response.getheader('Retry-After')
+            error = f"{response.status} {response.reason}"
+        except (http.client.IncompleteRead, http.client.BadStatusLine, OSError) as err:
+            close_connections()  # the failed one may be half-read, reconnect on the next attempt
+            error = repr(err)
+        if attempt == retries:
+            raise http.client.HTTPException(f"Failed to download {url} after {retries + 1} attempts: {error}")
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt + random.random()
+        print(f"Retrying {url} in {delay:.1f} seconds ({error})")
+        time.sleep(delay)
+
+# Helper: Incrementally extracts emojis (<li class='emoji'> blocks with an <img> and a <div class='name'>:name:</div>)
+# and the next page link from a Slackmojis page, as it is fed
+class EmojiPageParser(html.parser.HTMLParser):
+    def __init__(self, name_pattern):
+        super().__init__()
+        self.name_pattern = name_pattern
+        self.emojis = []
+        self.block_count = 0
+        self.next_page = None
+        self._in_emoji = False
+        self._in_name = False
+        self._name = ""
+        self._img_url = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or "").split()
+        if tag == 'li' and 'emoji' in classes:
+            self._in_emoji, self._name, self._img_url = True, "", None
+            self.block_count += 1
+        elif self._in_emoji and tag == 'img' and self._img_url is None and attrs.get('src'):
+            self._img_url = attrs['src']  # attribute values come unescaped
+        elif self._in_emoji and tag == 'div' and 'name' in classes:
+            self._in_name = True
+        elif tag in ('a', 'link') and 'next' in (attrs.get('rel') or "").split() and attrs.get('href'):
+            self.next_page = attrs['href']
+
+    def handle_data(self, data):
+        if self._in_name:
+            self._name += data
+
+    def handle_endtag(self, tag):
+        if tag == 'div':
+            self._in_name = False
+        elif tag == 'li' and self._in_emoji:
+            self._in_emoji = False
+            name = self._name.strip().strip(':').strip()
+            if name and self._img_url and self.name_pattern.search(name):
+                self.emojis.append({'name': name, 'url': self._img_url})
+
+# Helper: Feeds a page to the parser chunk by chunk, as read() returns them
+def feed_page(parser, read, charset):
+    decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+    while chunk := read(CHUNK_SIZE):
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+
+# Helper: Parses one page of a category while it is received
+# With a cache, received pages are also saved, and parsed from there when the server answers 304
+def fetch_category_page(page_url, name_pattern, cache=None):
+    page_path = cache.page_path(page_url) if cache else None
+    response = http_get(page_url, cache.conditional_headers(page_url, page_path) if cache else None)
+    parser = EmojiPageParser(name_pattern)
+    if response.status == 304:
+        response.read()
+        with open(page_path, 'rb') as cached_page:
+            feed_page(parser, cached_page.read, cache.entry(page_url, page_path)['charset'])
+    elif response.status == 200:
+        charset = response.headers.get_content_charset() or 'utf-8'
+        if cache:
+            with open(f"{page_path}.part", 'wb') as cached_page:
+                def read_and_save(size):
+                    chunk = response.read(size)
+                    cached_page.write(chunk)
+                    return chunk
+                feed_page(parser, read_and_save, charset)
+            os.replace(f"{page_path}.part", page_path)
+            cache.store(page_url, page_path, response, charset=charset)
+        else:
+            feed_page(parser, response.read, charset)
+    else:
+        response.read()
+        raise http.client.HTTPException(f"{response.status} {response.reason} for {page_url}")
+    return parser
+
+# Helper: Emojis of every page of a category
+# A page failing ends the pagination (its next page link is unknown), the emojis of the earlier pages are kept
+def fetch_category_emojis(category, name_pattern, cache=None):
     emojis = []
-    for block in emoji_blocks:
-        # Find emoji name (any name containing 'meow', case-insensitive, allow whitespace/newlines)
-        name_match = re.search(r"<div class=['\"]name['\"][^>]*>\s*:([^:]*meow[^:]*):\s*</div>", block, re.IGNORECASE | re.DOTALL)
-        if not name_match:
-            continue
-        name = name_match.group(1).strip()
-        # Find image url (single or double quotes)
-        img_match = re.search(r"<img[^>]+src=['\"]([^'\"]+)['\"]", block)
-        if not img_match:
-            continue
-        img_url = html.unescape(img_match.group(1))
-        emojis.append({'name': name, 'url': img_url})
-    print(f"DEBUG: Found {len(emojis)} emojis with 'meow' in the name.")
+    page_url = SLACKMOJIS_CATEGORY_URL.format(category=category)
+    visited = set()
+    while page_url and page_url not in visited:
+        visited.add(page_url)
+        try:
+            parser = fetch_category_page(page_url, name_pattern, cache)
+        except (http.client.HTTPException, OSError) as err:
+            print(f"Failed to fetch page {page_url} of category {category}: {err}")
+            break
+        print(f"DEBUG: Found {parser.block_count} <li class='emoji'> blocks on {page_url}, {len(parser.emojis)} matching.")
+        for emoji in parser.emojis:
+            emoji['url'] = urllib.parse.urljoin(page_url, emoji['url'])
+        emojis.extend(parser.emojis)
+        page_url = urllib.parse.urljoin(page_url, parser.next_page) if parser.next_page else None
+    return emojis
+
+# Step 1: Scrape the Slackmojis category pages for emojis whose name matches name_filter (a case-insensitive regex)
+def fetch_meow_emojis(categories=DEFAULT_CATEGORIES, name_filter=DEFAULT_NAME_FILTER, workers=DOWNLOAD_WORKERS, cache=None):
+    name_pattern = re.compile(name_filter, re.IGNORECASE)
+    # Categories are crawled concurrently, their results are still merged in the given order
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(categories)))) as executor:
+        futures = [executor.submit(fetch_category_emojis, category, name_pattern, cache) for category in categories]
+    if cache:
+        cache.save()
+    emojis = []
+    seen_urls = set()
+    for future in futures:
+        # The same emoji can be listed in several categories
+        for emoji in future.result():
+            if emoji['url'] not in seen_urls:
+                seen_urls.add(emoji['url'])
+                emojis.append(emoji)
+    print(f"DEBUG: Found {len(emojis)} emojis matching '{name_filter}' in the name.")
     return emojis
 
 # Step 2: Download all found emojis
-def download_emojis(emojis):
+def download_emojis(emojis, workers=DOWNLOAD_WORKERS, cache=None):
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
    # if len(emojis) > 50:
       #  emojis = random.sample(emojis, 50)
        # print(f"Selected 50 random emojis for download.")
+    # Filenames are all picked upfront in list order, so duplicates get the same suffixes whatever order downloads finish in
     used_filenames = set()
     for emoji in emojis:
         # Remove query params from URL for extension
@@ -80,77 +301,276 @@ def download_emojis(emojis):
             filename = f"{emoji['name']}_{count}{ext}"
             count += 1
         used_filenames.add(filename)
-        dest = os.path.join(DOWNLOAD_DIR, filename)
-        print(f"Downloading {emoji['name']} -> {dest}")
-        download_file(emoji['url'], dest)
-        emoji['file_path'] = dest
+        emoji['file_path'] = os.path.join(DOWNLOAD_DIR, filename)
+
+    def download(emoji):
+        print(f"Downloading {emoji['name']} -> {emoji['file_path']}")
+        try:
+            if not download_file(emoji['url'], emoji['file_path'], cache=cache):
+                print(f"{emoji['name']} unchanged since the last run")
+        except (http.client.HTTPException, OSError) as err:
+            # Its file_path is left missing, the upload skips it
+            print(f"Failed to download {emoji['name']}: {err}")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(download, emojis))
+    if cache:
+        cache.save()
     return emojis
 
-# Step 3: Upload emojis to Discord
-def upload_to_discord(emojis, guild_id, bot_token):
+# Helper: Discord REST client over one persistent connection, pacing requests with the rate limit bucket headers
+class DiscordClient:
+    def __init__(self, bot_token):
+        self.bot_token = bot_token
+        self.conn = http.client.HTTPSConnection(DISCORD_API_HOST, timeout=30)
+        self.buckets = {}  # route -> (requests remaining, time.monotonic() at which the bucket resets)
+
+    def request(self, method, path, route, payload=None):
+        # Returns (status, JSON body), after waiting out an exhausted bucket and retrying 429s and network errors
+        for attempt in range(MAX_REQUEST_RETRIES + 1):
+            remaining, reset_at = self.buckets.get(route, (None, 0))
+            if remaining == 0 and reset_at > time.monotonic():
+                wait = reset_at - time.monotonic()
+                print(f"Rate limit bucket of {route} exhausted, waiting {wait:.1f} seconds...")
+                time.sleep(wait)
+            headers = {"Authorization": f"Bot {self.bot_token}", "User-Agent": USER_AGENT}
+            if payload is not None:
+                headers["Content-Type"] = "application/json"
+            try:
+                self.conn.request(method, DISCORD_API_PATH + path, body=json.dumps(payload) if payload is not None else None, headers=headers)
+                resp = self.conn.getresponse()
+                resp_body = resp.read().decode('utf-8')
+            except (http.client.HTTPException, OSError) as err:
+                self.conn.close()  # reconnects on the next request
+                if attempt == MAX_REQUEST_RETRIES:
+                    raise
+                print(f"Request to {route} failed ({err!r}), retrying...")
+                time.sleep(2 ** attempt + random.random())
+                continue
+            if resp.getheader('X-RateLimit-Remaining') is not None:
+                self.buckets[route] = (int(resp.getheader('X-RateLimit-Remaining')),
+                                       time.monotonic() + float(resp.getheader('X-RateLimit-Reset-After', 0)))
+            try:
+                data = json.loads(resp_body) if resp_body else None
+            except ValueError:
+                data = resp_body
+            if resp.status == 429 and attempt < MAX_REQUEST_RETRIES:
+                retry_after = float(data.get("retry_after", 5)) if isinstance(data, dict) else float(resp.getheader('Retry-After', 5))
+                scope = "globally" if isinstance(data, dict) and data.get("global") else f"on {route}"
+                print(f"Rate limited {scope}, retrying after {retry_after} seconds...")
+                time.sleep(retry_after)
+                continue
+            return resp.status, data
+
+    def close(self):
+        self.conn.close()
+
+# Helper: Upload progress, {guild id: {emoji image URL: Discord emoji id}}, so an interrupted upload resumes where it stopped
+def load_progress(progress_file):
+    try:
+        with open(progress_file, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_progress(progress_file, progress):
+    with open(f"{progress_file}.part", 'w', encoding='utf-8') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(f"{progress_file}.part", progress_file)
+
+# Helper: Real image type from the file's magic bytes, whatever its extension says
+def image_mime_type(data):
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def _resized_frame(frame, max_dimension):
+    frame = frame.convert('RGBA')
+    frame.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    return frame
+
+def _encode_static(image, max_dimension, colors, frame_step):
+    frame = _resized_frame(image, max_dimension)
+    if colors:
+        frame = frame.quantize(colors, method=Image.Quantize.FASTOCTREE)
+    output = io.BytesIO()
+    frame.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+def _encode_animated(image, max_dimension, colors, frame_step):
+    frames, durations = [], []
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        duration = frame.info.get('duration', 100)
+        if index % frame_step:
+            durations[-1] += duration  # a dropped frame's time goes to the kept one, so the animation keeps its speed
+            continue
+        frame = _resized_frame(frame, max_dimension)
+        # GIF transparency is a single palette entry: quantized to one color less, transparent pixels get the last one
+        transparent_mask = frame.getchannel('A').point(lambda alpha: 255 if alpha < 128 else 0)
+        frame = frame.convert('RGB').quantize(colors - 1, method=Image.Quantize.FASTOCTREE)
+        frame.paste(colors - 1, mask=transparent_mask)
+        frame.info['transparency'] = colors - 1
+        frames.append(frame)
+        durations.append(duration)
+    output = io.BytesIO()
+    frames[0].save(output, 'GIF', save_all=True, append_images=frames[1:], duration=durations, loop=image.info.get('loop', 0),
+                   disposal=2, optimize=True)
+    return output.getvalue()
+
+# Helper: Shrinks an image under max_bytes (run in a worker process), returns the path of the shrunk copy or None when it can't fit
+# Copies are named after the source's content hash, so an unchanged emoji is never optimized twice
+def optimize_image(source_path, optimized_dir=OPTIMIZED_DIR, max_bytes=MAX_EMOJI_SIZE):
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    for ext in ('.png', '.gif'):
+        if os.path.exists(os.path.join(optimized_dir, digest + ext)):
+            return os.path.join(optimized_dir, digest + ext)
+    failed_marker = os.path.join(optimized_dir, digest + '.failed')
+    if os.path.exists(failed_marker):
+        return None
+
+    with Image.open(source_path) as image:
+        animated = getattr(image, 'n_frames', 1) > 1
+        for max_dimension, colors, frame_step in ANIMATED_OPTIMIZE_STEPS if animated else STATIC_OPTIMIZE_STEPS:
+            output = (_encode_animated if animated else _encode_static)(image, max_dimension, colors, frame_step)
+            if len(output) <= max_bytes:
+                dest = os.path.join(optimized_dir, digest + ('.gif' if animated else '.png'))
+                with open(f"{dest}.part", 'wb') as f:
+                    f.write(output)
+                os.replace(f"{dest}.part", dest)
+                return dest
+    open(failed_marker, 'wb').close()
+    return None
+
+# Step 3: Shrink the emojis over Discord's size limit on a process pool (it's CPU-bound), their copies get uploaded instead
+def optimize_emojis(emojis, workers=None, optimized_dir=OPTIMIZED_DIR):
+    oversized = [emoji for emoji in emojis if os.path.exists(emoji['file_path']) and os.path.getsize(emoji['file_path']) > MAX_EMOJI_SIZE]
+    if not oversized:
+        return emojis
+    if Image is None:
+        print(f"Pillow is not installed, {len(oversized)} emojis over {MAX_EMOJI_SIZE // 1024} KB won't be uploaded.")
+        return emojis
+
+    os.makedirs(optimized_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(optimize_image, emoji['file_path'], optimized_dir) for emoji in oversized]
+    for emoji, future in zip(oversized, futures):
+        try:
+            optimized_path = future.result()
+        except (OSError, ValueError) as err:  # includes Pillow's UnidentifiedImageError
+            print(f"Failed to optimize {emoji['name']}: {err}")
+            continue
+        if optimized_path is None:
+            print(f"Could not shrink {emoji['name']} under {MAX_EMOJI_SIZE // 1024} KB.")
+            continue
+        emoji['upload_path'] = optimized_path
+        print(f"Optimized {emoji['name']}: {os.path.getsize(emoji['file_path'])} -> {os.path.getsize(optimized_path)} bytes")
+    return emojis
+
+# Step 4: Upload emojis to Discord
+def upload_to_discord(emojis, guild_id, bot_token, progress_file=PROGRESS_FILE):
+    client = DiscordClient(bot_token)
+    progress = load_progress(progress_file)
+    uploaded = progress.setdefault(str(guild_id), {})
+
+    # Preflight: the guild lists its emojis and boost tier once, so duplicates are skipped and slot limits known upfront
+    status, guild = client.request("GET", f"/guilds/{guild_id}", "GET /guilds/{guild_id}")
+    if status != 200:
+        print(f"Failed to fetch guild {guild_id}: {status} | {guild}")
+        client.close()
+        return
+    existing_names = {guild_emoji['name'] for guild_emoji in guild['emojis']}
+    slots = EMOJI_SLOTS_BY_TIER.get(guild.get('premium_tier', 0), EMOJI_SLOTS_BY_TIER[0])
+    free_slots = {animated: slots - sum(bool(guild_emoji.get('animated')) == animated for guild_emoji in guild['emojis'])
+                  for animated in (False, True)}
+    print(f"Guild has {len(guild['emojis'])} emojis, {free_slots[False]} static and {free_slots[True]} animated slots left.")
+
     for emoji in emojis:
         # Discord emoji name requirements: <=32 chars, alphanumeric/underscore only
         valid_name = re.sub(r'[^a-zA-Z0-9_]', '_', emoji['name'])[:32]
-        if not os.path.exists(emoji['file_path']):
+        if emoji['url'] in uploaded:
+            print(f"Skipping {emoji['name']}: already uploaded by a previous run.")
+            continue
+        if valid_name in existing_names:
+            print(f"Skipping {emoji['name']}: the guild already has a :{valid_name}: emoji.")
+            continue
+        # The optimized copy when the downloaded file was too large
+        file_path = emoji.get('upload_path', emoji['file_path'])
+        if not os.path.exists(file_path):
             print(f"Skipping {emoji['name']}: file not found.")
             continue
-        file_size = os.path.getsize(emoji['file_path'])
-        if file_size > 256 * 1024:
+        file_size = os.path.getsize(file_path)
+        if file_size > MAX_EMOJI_SIZE:
             print(f"Skipping {emoji['name']}: file too large ({file_size} bytes).")
             continue
-        with open(emoji['file_path'], 'rb') as f:
+        with open(file_path, 'rb') as f:
             img_data = f.read()
-        b64_img = "data:image/png;base64," + base64.b64encode(img_data).decode('utf-8')
-        payload = json.dumps({
-            "name": valid_name,
-            "image": b64_img
-        })
-        attempt = 0
-        while True:
-            conn = http.client.HTTPSConnection("discord.com")
-            endpoint = f"/api/v10/guilds/{guild_id}/emojis"
-            headers = {
-                "Authorization": f"Bot {bot_token}",
-                "Content-Type": "application/json"
-            }
-            conn.request("POST", endpoint, body=payload, headers=headers)
-            resp = conn.getresponse()
-            resp_body = resp.read().decode('utf-8')
-            if resp.status == 201:
-                print(f"Uploaded {emoji['name']} to Discord.")
-                conn.close()
-                break
-            elif resp.status == 429:
-                try:
-                    data = json.loads(resp_body)
-                    retry_after = float(data.get("retry_after", 5))
-                except Exception:
-                    retry_after = 5
-                print(f"Rate limited on {emoji['name']}, retrying after {retry_after} seconds...")
-                conn.close()
-                time.sleep(retry_after)
-                attempt += 1
-                if attempt > 2:
-                    print(f"Failed to upload {emoji['name']} after multiple retries.")
-                    break
-                continue
-            else:
-                print(f"Failed to upload {emoji['name']}: {resp.status} {resp.reason} | {resp_body}")
-                conn.close()
+        mime_type = image_mime_type(img_data)
+        if mime_type is None:
+            print(f"Skipping {emoji['name']}: not a PNG, GIF, JPEG or WebP image.")
+            continue
+        # Discord makes every GIF an animated emoji, they have their own slots
+        animated = mime_type == 'image/gif'
+        if free_slots[animated] <= 0:
+            if free_slots[not animated] <= 0:
+                print("No emoji slots left in the guild, stopping the upload.")
                 break
+            print(f"Skipping {emoji['name']}: no {'animated' if animated else 'static'} emoji slots left.")
+            continue
+        b64_img = f"data:{mime_type};base64," + base64.b64encode(img_data).decode('utf-8')
+        status, data = client.request("POST", f"/guilds/{guild_id}/emojis", "POST /guilds/{guild_id}/emojis",
+                                      {"name": valid_name, "image": b64_img})
+        if status == 201:
+            print(f"Uploaded {emoji['name']} to Discord.")
+            uploaded[emoji['url']] = data['id']
+            existing_names.add(valid_name)
+            free_slots[animated] -= 1
+            save_progress(progress_file, progress)
+        else:
+            print(f"Failed to upload {emoji['name']}: {status} | {data}")
+    client.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the meow emojis from Slackmojis and import them into a Discord server.")
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS, help="Number of concurrent emoji downloads and category crawls.")
+    parser.add_argument("--category", dest="categories", action="append", default=None,
+                        help=f"Slackmojis category to scrape, e.g. 25-blob-cats-emojis (repeatable, default {DEFAULT_CATEGORIES}).")
+    parser.add_argument("--name-filter", default=DEFAULT_NAME_FILTER,
+                        help="Case-insensitive regex emoji names must match (default 'meow', use '.' for every emoji).")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help="Directory of the HTTP cache, pages and images unchanged since the last run are not downloaded again.")
+    parser.add_argument("--no-cache", action="store_true", help="Download everything again, without reading or updating the cache.")
+    parser.add_argument("--upload", action="store_true",
+                        help="Upload the emojis to the Discord server set by DISCORD_SERVER_ID/DISCORD_BOT_TOKEN (only downloads them otherwise).")
+    parser.add_argument("--progress-file", default=PROGRESS_FILE,
+                        help="File recording the emojis already uploaded, so an interrupted upload resumes where it stopped.")
+    parser.add_argument("--optimize-workers", type=int, default=None,
+                        help="Processes shrinking the emojis over 256 KB (default: one per CPU).")
+    args = parser.parse_args()
+    cache = None if args.no_cache else HttpCache(args.cache_dir)
+
     # Load .env if present
     dotenv.load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
     server_id = os.environ.get("DISCORD_SERVER_ID")
     bot_token = os.environ.get("DISCORD_BOT_TOKEN")
 
-    print("Fetching emojis with 'meow' in the name from Slackmojis...")
-    emojis = fetch_meow_emojis()
+    print(f"Fetching emojis with '{args.name_filter}' in the name from Slackmojis...")
+    emojis = fetch_meow_emojis(args.categories or DEFAULT_CATEGORIES, args.name_filter, workers=args.workers, cache=cache)
     print(f"Found {len(emojis)} matching emojis.")
-    emojis = download_emojis(emojis)
-    print("\nTo upload to Discord, set your DISCORD_SERVER_ID and DISCORD_BOT_TOKEN in a .env file or as environment variables.")
-    #if server_id and bot_token:
-        #upload_to_discord(emojis, server_id, bot_token)
-    #else:
-    print("Skipping Discord upload (no credentials provided). Downloaded files are in:", DOWNLOAD_DIR)
+    emojis = download_emojis(emojis, workers=args.workers, cache=cache)
+    emojis = optimize_emojis(emojis, workers=args.optimize_workers)
+    # Uploading changes the guild, so it only happens when asked for, whatever credentials the .env holds
+    if not args.upload:
+        print("\nSkipping Discord upload (run with --upload to import them). Downloaded files are in:", DOWNLOAD_DIR)
+    elif server_id and bot_token:
+        upload_to_discord(emojis, server_id, bot_token, progress_file=args.progress_file)
+    else:
+        print("\nTo upload to Discord, set your DISCORD_SERVER_ID and DISCORD_BOT_TOKEN in a .env file or as environment variables.")
+        exit(1)